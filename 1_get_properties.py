@@ -1,61 +1,81 @@
-import requests
 from bs4 import BeautifulSoup
-import csv
+import json
 from urllib.parse import urljoin
-import time
 import re
-import os
-from urllib.request import urlretrieve, URLError
+import multiprocessing
+import queue
+import threading
+from canonical_keys import listing_key
+from http_client import client, rate_limits
+from listing_history import ListingHistory
+from metrics import metrics
+from photo_store import photo_source, queue_sync, wait_for_syncs
+from property_store import KEY, PropertyStore
 
 # Configuration
 headers = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
 }
-base_url = "https://www.redfin.com/county/1255/LA/Jefferson-Parish/filter/property-type=house+townhouse+multifamily,max-price=220k,min-beds=2,min-baths=1.5,min-sqft=1.2k-sqft,hoa=0"
-output_csv = '1_properties.csv'
-photo_base_dir = 'Photos'
-
-# Create directories if they don't exist
-os.makedirs(photo_base_dir, exist_ok=True)
-
-def clean_filename(text):
-    return re.sub(r'[<>:"/\\|?*]', '', text.strip())
+# Searches to scrape. Each runs in its own worker process with its own request budget,
+# and listings found by more than one search are kept once. 'source' is 'html' to parse
+# the search result pages at 'url', or 'json' to read Redfin's GIS search feed with
+# 'params' applied on top of gis_params.
+searches = [
+    {
+        'name': 'Jefferson Parish',
+        'source': 'html',
+        'url': "https://www.redfin.com/county/1255/LA/Jefferson-Parish/filter/property-type=house+townhouse+multifamily,max-price=220k,min-beds=2,min-baths=1.5,min-sqft=1.2k-sqft,hoa=0"
+    },
+    # {'name': 'Orleans Parish', 'source': 'json', 'params': {'region_id': 1336}},
+]
+search_workers = 3  # Searches scraped at the same time
+result_batch_size = 50  # Rows a search worker sends back at a time
+gis_url = "https://www.redfin.com/stingray/api/gis"
+gis_params = {
+    'al': 1,
+    'region_id': 1255,
+    'region_type': 5,
+    'uipt': '1,2,4',
+    'max_price': 220000,
+    'num_beds': 2,
+    'min_baths': 1.5,
+    'min_sqft': 1250,
+    'hoa': 0,
+    'v': 8
+}
+gis_page_size = 350  # Homes requested per feed page
+# Columns this stage owns in the property store
+columns = {
+    'Street': 'TEXT',
+    'City': 'TEXT',
+    'State': 'TEXT',
+    'ZIP Code': 'TEXT',
+    'Price': 'REAL',
+    'Beds': 'REAL',
+    'Baths': 'REAL',
+    'Square Feet': 'REAL',
+    'URL': 'TEXT',
+    'Listed Latitude': 'REAL',
+    'Listed Longitude': 'REAL',
+    'Active': 'INTEGER',
+    'Listing Change': 'TEXT',  # new, relisted, changed or unchanged since the previous scrape
+    'Changed Fields': 'TEXT',
+    'First Seen': 'TEXT',
+    'Photo Source': 'TEXT'  # Photo set and count, for fetching the listing's photos later
+}
+# 'filtered' leaves photos to stage 4, which fetches them only for listings that pass
+# the filter (the viewer fetches any others it opens); 'all' downloads every listing's
+# photos while scraping
+photo_downloads = 'filtered'
 
-def download_images_from_base(preview_url, photo_dir):
-    os.makedirs(photo_dir, exist_ok=True)
+# Row field carrying (photo set, photo count) from a search worker to the main process,
+# which handles each listing's photos once however many searches found it
+PHOTOS = '_photos'
 
-    # Match pattern from preview image URL
+def parse_preview_url(preview_url):
+    """Pull (region, folder, base_id, top_id) out of a listing's preview image URL"""
     match = re.search(r'photo/(\d+)/islphoto/(\d+)/[^.]*\.(\d+)_(\d)\.jpg', preview_url)
-    if not match:
-        print(f"Could not parse image preview URL: {preview_url}")
-        return
-
-    region, folder, base_id, top_id = match.groups()
-    
-    for i in range(30):  # Try up to 30 images
-        if i == 0:
-            img_url = f"https://ssl.cdn-redfin.com/photo/{region}/bigphoto/{folder}/{base_id}_{top_id}.jpg"
-        else:
-            img_url = f"https://ssl.cdn-redfin.com/photo/{region}/bigphoto/{folder}/{base_id}_{i}_{top_id}.jpg"
-
-        img_path = os.path.join(photo_dir, f"{i:04d}.jpg")
-        if os.path.exists(img_path):
-            continue
-
-        try:
-            response = requests.get(img_url, stream=True, timeout=5)
-            if response.status_code == 200:
-                with open(img_path, 'wb') as f:
-                    for chunk in response.iter_content(1024):
-                        f.write(chunk)
-                print(f"Downloaded: {img_url}")
-            else:
-                if i == 0:
-                    print(f"First image not found for: {base_id}")
-                break  # Stop if image doesn't exist (likely end of photo set)
-        except URLError as e:
-            print(f"Failed to download {img_url}: {e}")
-            break
+    return match.groups() if match else None
 
 def extract_property_data(card, url):
     try:
@@ -83,13 +103,7 @@ def extract_property_data(card, url):
         img_tag = card.find('img', class_='bp-Homecard__Photo--image')
         preview_url = img_tag['src'] if img_tag and img_tag.has_attr('src') else None
 
-        photo_dir = os.path.join(photo_base_dir, f"{zip_code}_{clean_filename(street)}")
-        if preview_url:
-            if not preview_url.startswith("http"):
-                preview_url = f"https:{preview_url}"
-            download_images_from_base(preview_url, photo_dir)
-
-        return {
+        row = {
             'Street': street,
             'City': city,
             'State': state,
@@ -98,54 +112,300 @@ def extract_property_data(card, url):
             'Beds': beds,
             'Baths': baths,
             'Square Feet': sqft,
-            'URL': property_url
+            'URL': property_url,
+            'Listed Latitude': None,
+            'Listed Longitude': None
         }
+
+        if preview_url:
+            photo_set = parse_preview_url(preview_url)
+            if photo_set:
+                row[PHOTOS] = (photo_set, None)
+            else:
+                print(f"Could not parse image preview URL: {preview_url}")
+        return row
     except Exception as e:
         print(f"Error processing property: {e}")
         return None
 
-def scrape_redfin():
-    properties = []
-    page_num = 1
+def count_feed_photos(photos):
+    """Number of photos photo_url can address from the feed's range string, e.g. '0-24:0' or '0-9:0,11-14:1'.
+
+    Only the first range is counted: the photo set keeps that range's top id and
+    photo_url assumes indexes 0 to count - 1. 0 if the first range does not start at 0.
+    """
+    indexes = (photos or '').split(',')[0].split(':')[0]
+    start, _, end = indexes.partition('-')
+    try:
+        if int(start) != 0:
+            return 0
+        return int(end or start) + 1
+    except ValueError:
+        return 0
+
+def extract_gis_home(home, url):
+    """Build a property row from one home in the GIS search feed"""
+    try:
+        def value(key):
+            field = home.get(key)
+            return field.get('value') if isinstance(field, dict) else field
 
-    while True:
-        print(f"Processing page {page_num}...")
-        url = f"{base_url}/page-{page_num}" if page_num > 1 else base_url
+        street = value('streetLine') or "N/A"
+        zip_code = value('zip') or value('postalCode') or "N/A"
+        lat_long = value('latLong') or {}
 
-        try:
-            response = requests.get(url, headers=headers)
+        row = {
+            'Street': street,
+            'City': home.get('city') or "N/A",
+            'State': home.get('state') or "N/A",
+            'ZIP Code': zip_code,
+            'Price': value('price'),
+            'Beds': home.get('beds'),
+            'Baths': home.get('baths'),
+            'Square Feet': value('sqFt'),
+            'URL': urljoin(url, home.get('url', '')),
+            'Listed Latitude': lat_long.get('latitude'),
+            'Listed Longitude': lat_long.get('longitude')
+        }
+
+        mls_id = str(value('mlsId') or '')
+        photos = value('photos')
+        photo_count = count_feed_photos(photos)
+        if mls_id and photo_count:
+            top_id = photos.split(',')[0].split(':')[-1] if ':' in photos else '0'
+            photo_set = (str(home.get('dataSourceId')), mls_id[-3:], mls_id, top_id)
+            row[PHOTOS] = (photo_set, photo_count)
+        return row
+    except Exception as e:
+        print(f"Error processing property: {e}")
+        return None
+
+def page_request(search, page_num):
+    """URL and query parameters for one page of a search"""
+    if search['source'] == 'json':
+        return search.get('url', gis_url), {**gis_params, **search.get('params', {}),
+                                            'num_homes': gis_page_size, 'page_number': page_num}
+    return (f"{search['url']}/page-{page_num}" if page_num > 1 else search['url']), None
+
+def fetch_pages(search, pages, more, stop):
+    """Fetch result pages in order, one page ahead of the parser within the politeness budget.
+
+    After each page the fetcher waits on more, which the parser releases once it has
+    read that page and seen it has a next page (or sets stop and releases to end).
+    """
+    # Page requests are paced by the Redfin rate limit in http_client.rate_limits
+    page_num, url = 1, None
+    try:
+        while not stop.is_set():
+            url, params = page_request(search, page_num)
+            response = client.get(url, params=params, headers=headers)
+            pages.put((page_num, url, response))
             if response.status_code != 200:
-                print(f"Stopped at page {page_num} (status code: {response.status_code})")
                 break
+            more.acquire()
+            page_num += 1
+    except Exception as e:
+        # Any failure (a request error, a search missing its url) is handed to the parser to raise
+        pages.put((page_num, url, e))
+    finally:
+        pages.put(None)  # The parser waits for this, so it is always sent
 
-            soup = BeautifulSoup(response.text, 'html.parser')
-            property_cards = soup.find_all('div', class_='MapHomeCardReact')
+def parse_page(html, url, page_num):
+    """Parse one result page into rows; rows is None when the page has no cards"""
+    soup = BeautifulSoup(html, 'html.parser')
+    property_cards = soup.find_all('div', class_='MapHomeCardReact')
+    if not property_cards:
+        return None, False
 
-            if not property_cards:
-                print("No more properties found.")
+    rows = []
+    for card in property_cards:
+        prop_data = extract_property_data(card, url)
+        if prop_data:
+            rows.append(prop_data)
+
+    has_next = soup.find('span', class_='ButtonLabel', string=str(page_num + 1)) is not None
+    return rows, has_next
+
+def parse_gis_page(text, url, page_num):
+    """Parse one page of the GIS feed; same contract as parse_page"""
+    # The feed is prefixed with '{}&&' to stop it being evaluated as a script
+    data = json.loads(text[text.index('{', 1) if text.startswith('{}&&') else 0:])
+    if data.get('resultCode', 0) != 0:
+        raise ValueError(f"Search feed error: {data.get('errorMessage')}")
+
+    homes = (data.get('payload') or {}).get('homes') or []
+    if not homes:
+        return None, False
+
+    rows = []
+    for home in homes:
+        prop_data = extract_gis_home(home, url)
+        if prop_data:
+            rows.append(prop_data)
+    return rows, len(homes) >= gis_page_size
+
+def scrape_search(search):
+    """Yield property rows page by page as one search is scraped"""
+    # Fetcher thread -> parser (this generator) -> consumer.
+    # Once a page is parsed and has a next page, the fetcher requests it while this
+    # page's rows are consumed; it never requests a page past the last one.
+    parse = parse_gis_page if search['source'] == 'json' else parse_page
+    pages = queue.Queue(maxsize=1)
+    more = threading.Semaphore(0)
+    stop = threading.Event()
+    fetcher = threading.Thread(target=fetch_pages, args=(search, pages, more, stop), daemon=True)
+    fetcher.start()
+    fetcher_done = False
+    try:
+        while True:
+            item = pages.get()
+            if item is None:
+                fetcher_done = True
                 break
+            page_num, url, response = item
+            print(f"{search['name']}: processing page {page_num}...")
 
-            for card in property_cards:
-                prop_data = extract_property_data(card, url)
-                if prop_data:
-                    properties.append(prop_data)
+            # A page that cannot be fetched or read fails the search; only a page with no
+            # results (or no next page) ends it, so a failed search never looks complete
+            if isinstance(response, Exception):
+                raise RuntimeError(f"Page {page_num} failed: {response}") from response
+            if response.status_code != 200:
+                raise RuntimeError(f"Page {page_num} failed (status code: {response.status_code})")
 
-            if not soup.find('span', class_='ButtonLabel', string=str(page_num + 1)):
+            rows, has_next = parse(response.text, response.url, page_num)
+            if rows is None:
+                print("No more properties found.")
+                break
+            if has_next:
+                more.release()  # Fetch the next page while these rows are consumed
+            yield from rows
+            if not has_next:
                 break
+    finally:
+        # Wake the fetcher and discard any page it fetched, so it is never left blocked
+        stop.set()
+        more.release()
+        while not fetcher_done:
+            fetcher_done = pages.get() is None
+        fetcher.join()
 
-            page_num += 1
-            time.sleep(1)
-
-        except Exception as e:
-            print(f"Error processing page {page_num}: {e}")
-            break
-
-    if properties:
-        with open(output_csv, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=properties[0].keys())
-            writer.writeheader()
-            writer.writerows(properties)
-        print(f"Saved {len(properties)} properties to {output_csv}")
+def search_worker(search, results, limits):
+    """Worker process: scrape one search, sending rows back in batches"""
+    rate_limits.update(limits)  # The parent's limits, including any set at run time
+    try:
+        batch = []
+        for row in scrape_search(search):
+            batch.append(row)
+            if len(batch) >= result_batch_size:
+                results.put(('rows', search['name'], batch))
+                batch = []
+        results.put(('rows', search['name'], batch))
+        outcome = ('done', search['name'], None)
+    except BaseException as e:
+        results.put(('rows', search['name'], batch))  # Keep what was scraped before the failure
+        outcome = ('failed', search['name'], repr(e))
+    # This process's request timings and counts, for the parent's run report
+    results.put(('metrics', search['name'], metrics.snapshot()))
+    results.put(outcome)
+
+def scrape_properties():
+    """Yield each listing once across all searches, as the worker processes find them"""
+    # Spawned rather than forked, since the pipeline runs other stages' threads in this process
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue(maxsize=search_workers * 4)
+    waiting = list(searches)
+    running = {}
+    seen = set()
+    failed = []
+    counts = {search['name']: [0, 0] for search in searches}  # Listings found, and found before by another search
+
+    def start_next():
+        search = waiting.pop(0)
+        process = context.Process(target=search_worker, args=(search, results, rate_limits), daemon=True)
+        process.start()
+        running[search['name']] = process
+
+    try:
+        while waiting and len(running) < search_workers:
+            start_next()
+        while running:
+            try:
+                kind, name, payload = results.get(timeout=1)
+            except queue.Empty:
+                # A worker that died without reporting (e.g. killed) would otherwise hang the scrape
+                for name, process in list(running.items()):
+                    if not process.is_alive() and process.exitcode != 0:
+                        print(f"{name}: worker exited with code {process.exitcode}")
+                        failed.append(name)
+                        del running[name]
+                        if waiting:
+                            start_next()
+                continue
+
+            if kind == 'rows':
+                for row in payload:
+                    key = listing_key(row)
+                    counts[name][0] += 1
+                    if key in seen:
+                        counts[name][1] += 1
+                        continue
+                    seen.add(key)
+                    row[KEY] = key
+                    photos = row.pop(PHOTOS, None)
+                    row['Photo Source'] = photo_source(*photos) if photos else None
+                    if photos and photo_downloads == 'all':
+                        queue_sync(key, *photos, headers)
+                    yield row
+                continue
+            if kind == 'metrics':
+                metrics.merge(payload)
+                continue
+
+            if kind == 'failed':
+                print(f"{name}: search failed: {payload}")
+                failed.append(name)
+            running.pop(name).join()
+            if waiting:
+                start_next()
+    finally:
+        for process in running.values():
+            process.terminate()
+        wait_for_syncs()
+
+    for name, (found, duplicates) in counts.items():
+        print(f"{name}: {found} listings ({duplicates} already found by another search)")
+    print(f"{len(seen)} unique listings across {len(searches)} searches")
+    if failed:
+        # Otherwise the listings of a failed search would be left marked inactive as if delisted
+        raise RuntimeError(f"Searches failed: {', '.join(failed)}")
+
+def stream_properties(store):
+    """Set up stage 1; returns (owned columns, generator of rows) for the property store"""
+    history = ListingHistory(store)
+    history.begin()
+
+    def generate():
+        try:
+            for row in scrape_properties():
+                row['Active'] = 1
+                history.observe(row)
+                yield row
+        except BaseException:
+            # A search failed: listings it did not find are not known to be gone
+            history.abort()
+            raise
+        counts = history.finish()
+        print("Changes since the last scrape: " + ', '.join(f"{count} {change}" for change, count in counts.items()))
+
+    return columns, generate()
+
+def scrape_redfin():
+    store = PropertyStore()
+    store.ensure_columns(columns)
+    owned, rows = stream_properties(store)
+    # Rows are stored in small batches as they arrive, so a crash keeps everything scraped so far
+    saved = store.write_stream(rows, owned)
+    print(f"Saved {saved} properties to {store.path}")
 
 if __name__ == '__main__':
     scrape_redfin()
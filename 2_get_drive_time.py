@@ -1,120 +1,373 @@
-import csv
+import importlib
+import json
 import requests
 import os
+import time
 from datetime import datetime, timedelta
+from itertools import islice
+import numpy as np
+import pipeline
+from canonical_keys import KeyIndex, coordinate_key, normalize_address
+from geocode_cache import GeocodeCache
+from http_client import client
+from metrics import metrics
+from property_store import KEY, PropertyStore
+from road_graph import RoadGraph, haversine_meters
+
+filters = importlib.import_module('4_filter_properties')
+
+# Configuration
+geocode_url = "https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/findAddressCandidates"
+batch_geocode_url = "https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/geocodeAddresses"
+arcgis_token = os.environ.get('ARCGIS_TOKEN')  # The multi-address endpoint requires a token
+use_batch_geocoding = bool(arcgis_token)
+geocode_batch_size = 100  # Addresses per batch request; also the number of rows processed together
+request_workers = 8  # Geocode/routing requests in flight at once (each host is still rate limited)
+osrm_url = "http://router.project-osrm.org"
+osrm_max_coordinates = 100  # Coordinates per table request (the public server's limit)
+# 'osrm' asks the OSRM server; 'local' routes over an OSM road extract (.osm XML or
+# GeoJSON lines with highway/maxspeed/oneway tags) covering the search area
+routing_mode = 'osrm'
+road_graph_extract = 'road_graph.osm'
+road_graph_path = 'road_graph.npz'
+# Skip geocoding and routing for listings the filter rules in 4_filter_properties.py reject
+# anyway. Listings farther in a straight line from the first destination than max_drive_time
+# minutes at max_road_speed_mph are marked out_of_range without routing.
+prefilter = True
+max_road_speed_mph = 70  # No drive averages more than this
+
+# Drive times are computed to every destination. The first one fills the
+# "Drive Time (mins)" / "Distance (miles)" columns used by the filter; the
+# others get "Drive Time to <name> (mins)" / "Distance to <name> (miles)".
+destinations = {
+    'Work': "781 Lasalle St, New Orleans, LA 70112",
+}
+# Scraped fields that, when changed, mean a listing must be geocoded and routed again
+location_fields = ['Street', 'City', 'State', 'ZIP Code', 'Listed Latitude', 'Listed Longitude']
+
+geocode_cache = GeocodeCache()
+
+# Result of a lookup that failed for reasons other than the address (network error,
+# server error, unreadable response). Unlike None (no match) it is never cached.
+TRANSIENT = 'transient'
 
 def geocode_address(address):
-    """Convert address to coordinates using ArcGIS"""
+    """Convert address to coordinates, reading through the on-disk geocode cache"""
+    found, coords = geocode_cache.get(address)
+    metrics.count('cache_hits' if found else 'cache_misses', cache='geocode')
+    if found:
+        return coords
+    coords = request_geocode(address)
+    if coords is TRANSIENT:
+        return None
+    geocode_cache.put(address, coords)
+    return coords
+
+def request_geocode(address):
+    """Convert address to coordinates using ArcGIS; None if it has no match, TRANSIENT if the lookup failed"""
     try:
-        url = "https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/findAddressCandidates"
         params = {
             'f': 'json',
             'singleLine': address,
             'outFields': 'Match_addr,Addr_type',
             'maxLocations': 1
         }
-        response = requests.get(url, params=params).json()
-        
-        if response.get('candidates') and len(response['candidates']) > 0:
-            location = response['candidates'][0]['location']
+        response = client.get(geocode_url, params=params)
+        if response.status_code != 200:
+            raise ValueError(f"status code {response.status_code}")
+        data = response.json()
+        if 'error' in data:
+            raise ValueError(data['error'].get('message', data['error']))
+
+        if data.get('candidates') and len(data['candidates']) > 0:
+            location = data['candidates'][0]['location']
             return (location['y'], location['x'])  # ArcGIS returns (lat, lon) as (y, x)
-        
+
         return None
-    except Exception as e:
+    except (requests.RequestException, ValueError, KeyError) as e:
         print(f"Geocoding failed for {address}: {e}")
-        return None
+        return TRANSIENT
 
-def get_drive_time(start_coords, end_coords):
-    """Get drive time using OSRM"""
+def request_batch_geocode(addresses):
+    """Geocode a chunk of addresses in one ArcGIS request; rejects come back as None"""
+    records = [{'attributes': {'OBJECTID': i, 'SingleLine': address}} for i, address in enumerate(addresses)]
     try:
-        start_lon, start_lat = start_coords[1], start_coords[0]
-        end_lon, end_lat = end_coords[1], end_coords[0]
-        
-        url = f"http://router.project-osrm.org/route/v1/driving/{start_lon},{start_lat};{end_lon},{end_lat}?overview=false"
-        response = requests.get(url).json()
-        
-        if response.get('code') == 'Ok':
-            duration = response['routes'][0]['duration']  # in seconds
-            distance = response['routes'][0]['distance']  # in meters
-            return {
-                'duration_mins': round(duration / 60, 1),
-                'distance_miles': round(distance / 1609.34, 1)
-            }
-        return None
-    except Exception as e:
-        print(f"Routing failed: {e}")
+        data = {
+            'f': 'json',
+            'addresses': json.dumps({'records': records}),
+            'outSR': 4326,
+            'token': arcgis_token
+        }
+        response = client.post(batch_geocode_url, data=data).json()
+        if 'error' in response:
+            raise ValueError(response['error'].get('message', response['error']))
+
+        results = [None] * len(addresses)
+        for location in response.get('locations', []):
+            # Results are not guaranteed to come back in order; ResultID is the OBJECTID we sent
+            result_id = location.get('attributes', {}).get('ResultID')
+            point = location.get('location')
+            if result_id is not None and point and point.get('x') is not None \
+                    and location['attributes'].get('Status') != 'U':
+                results[result_id] = (point['y'], point['x'])
+        return results
+    except (requests.RequestException, ValueError, KeyError) as e:
+        print(f"Batch geocoding failed for {len(addresses)} addresses: {e}")
+        return [None] * len(addresses)
+
+def geocode_addresses(addresses):
+    """Geocode many addresses: cache first, then batch requests, then single lookups for rejects.
+
+    Returns a KeyIndex of coordinates keyed by normalized address, so every spelling
+    of an address finds the one result.
+    """
+    results = KeyIndex(normalize_address)
+    missed = KeyIndex(normalize_address)  # First spelling of each address the cache lacks
+    for address in addresses:
+        if address in results or address in missed:
+            continue
+        found, coords = geocode_cache.get(address)
+        if found:
+            results.put(address, coords)
+        else:
+            missed.put(address, address)
+    misses = missed.values()
+    metrics.count('cache_hits', len(results), cache='geocode')
+    metrics.count('cache_misses', len(misses), cache='geocode')
+
+    if use_batch_geocoding:
+        chunks = [misses[start:start + geocode_batch_size] for start in range(0, len(misses), geocode_batch_size)]
+        for chunk, chunk_results in zip(chunks, client.map(request_batch_geocode, chunks, request_workers)):
+            for address, coords in zip(chunk, chunk_results):
+                if coords:
+                    results.put(address, coords)
+                    geocode_cache.put(address, coords)
+
+    rejects = [address for address in misses if address not in results]
+    for address, coords in zip(rejects, client.map(request_geocode, rejects, request_workers)):
+        if coords is TRANSIENT:
+            results.put(address, None)  # Not cached, so the next run tries again
+            continue
+        results.put(address, coords)
+        geocode_cache.put(address, coords)
+    return results
+
+def listed_coordinates(row):
+    """Coordinates supplied by the listing source, if any (the JSON feed includes them)"""
+    try:
+        return (float(row['Listed Latitude']), float(row['Listed Longitude']))
+    except (KeyError, TypeError, ValueError):
         return None
 
-def calculate_free_drive_times(input_csv, output_csv):
-    # Check if output file already exists
-    existing_data = {}
-    if os.path.exists(output_csv):
-        with open(output_csv, mode='r') as existing_file:
-            reader = csv.DictReader(existing_file)
-            for row in reader:
-                # Use a unique identifier for each property (address in this case)
-                address_key = f"{row['Street']}, {row['City']}, {row['State']} {row['ZIP Code']}"
-                existing_data[address_key] = {
-                    'Coordinates': row.get('Coordinates', ''),
-                    'Drive Time (mins)': row.get('Drive Time (mins)', ''),
-                    'Distance (miles)': row.get('Distance (miles)', '')
-                }
-    
-    # Geocode the destination once
-    destination = "781 Lasalle St, New Orleans, LA 70112"
-    dest_coords = geocode_address(destination)
-    
-    if not dest_coords:
-        print("Failed to geocode destination address")
-        return
-    
-    with open(input_csv, mode='r') as infile, open(output_csv, mode='w', newline='') as outfile:
-        reader = csv.DictReader(infile)
-        fieldnames = reader.fieldnames + ['Coordinates', 'Drive Time (mins)', 'Distance (miles)']
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-        writer.writeheader()
-        
-        for row in reader:
-            # Construct the full address from separate components
-            origin = f"{row['Street']}, {row['City']}, {row['State']} {row['ZIP Code']}"
-            address_key = origin
-            
-            # Check if we have existing data for this property
-            if address_key in existing_data and existing_data[address_key]['Coordinates']:
-                existing_row = existing_data[address_key]
-                if (existing_row['Drive Time (mins)'] and 
-                    existing_row['Drive Time (mins)'] not in ["Geocoding failed", "Routing failed"] and
-                    existing_row['Distance (miles)'] and 
-                    existing_row['Distance (miles)'] not in ["Geocoding failed", "Routing failed"]):
-                    
-                    # Use existing data
-                    row['Coordinates'] = existing_row['Coordinates']
-                    row['Drive Time (mins)'] = existing_row['Drive Time (mins)']
-                    row['Distance (miles)'] = existing_row['Distance (miles)']
-                    writer.writerow(row)
-                    continue
-            
-            # If no existing data or data was invalid, process new request
-            origin_coords = geocode_address(origin)
-            
-            if origin_coords:
-                row['Coordinates'] = f"{origin_coords[0]}, {origin_coords[1]}"
-                route = get_drive_time(origin_coords, dest_coords)
-                if route:
-                    row['Drive Time (mins)'] = f"{route['duration_mins']}"
-                    row['Distance (miles)'] = f"{route['distance_miles']}"
+def request_drive_table(origins, dest_coords):
+    """One OSRM table request from origins to every destination; None marks unroutable pairs"""
+    coords = ';'.join(f"{lon},{lat}" for lat, lon in list(origins) + list(dest_coords))
+    params = {
+        'sources': ';'.join(str(i) for i in range(len(origins))),
+        'destinations': ';'.join(str(len(origins) + j) for j in range(len(dest_coords))),
+        'annotations': 'duration,distance'
+    }
+    try:
+        response = client.get(f"{osrm_url}/table/v1/driving/{coords}", params=params).json()
+        if response.get('code') != 'Ok':
+            raise ValueError(response.get('message', response.get('code')))
+
+        results = []
+        for durations, distances in zip(response['durations'], response['distances']):
+            routes = []
+            for duration, distance in zip(durations, distances):
+                if duration is None or distance is None:
+                    routes.append(None)  # No route between this pair
                 else:
-                    row['Drive Time (mins)'] = "Routing failed"
-                    row['Distance (miles)'] = "Routing failed"
+                    routes.append({
+                        'duration_mins': round(duration / 60, 1),
+                        'distance_miles': round(distance / 1609.34, 1)
+                    })
+            results.append(routes)
+        return results
+    except (requests.RequestException, ValueError, KeyError) as e:
+        print(f"Routing failed for {len(origins)} origins: {e}")
+        return [[None] * len(dest_coords) for _ in origins]
+
+def get_drive_times(origins, dest_coords, graph=None):
+    """Drive times from many origins to each destination, with OSRM table requests or the local road graph.
+
+    Returns one list per origin holding a route dict (or None) per destination.
+    """
+    if graph is not None:
+        return graph.drive_times(origins, dest_coords)
+    chunk_size = max(1, osrm_max_coordinates - len(dest_coords))
+    chunks = [origins[start:start + chunk_size] for start in range(0, len(origins), chunk_size)]
+    tables = client.map(lambda chunk: request_drive_table(chunk, dest_coords), chunks, request_workers)
+    return [routes for table in tables for routes in table]
+
+def drive_columns(name, index):
+    """Drive time and distance column names for the destination at index"""
+    if index == 0:
+        return 'Drive Time (mins)', 'Distance (miles)'
+    return f'Drive Time to {name} (mins)', f'Distance to {name} (miles)'
+
+def full_address(row):
+    return f"{row['Street']}, {row['City']}, {row['State']} {row['ZIP Code']}"
+
+def destination_columns():
+    return [drive_columns(name, i) for i, name in enumerate(destinations)]
+
+def owned_columns(route_columns):
+    """Columns this stage owns in the property store"""
+    columns = {'Latitude': 'REAL', 'Longitude': 'REAL', 'Geocode Status': 'TEXT'}
+    for time_col, dist_col in route_columns:
+        columns[time_col] = 'REAL'
+        columns[dist_col] = 'REAL'
+    columns['Route Status'] = 'TEXT'
+    columns['Route Basis'] = 'TEXT'  # What the routes were computed against; see route_basis
+    return columns
+
+def route_basis(dest_coords, graph=None):
+    """Routing mode (and road graph) and destination coordinates, so stored routes are only reused for the same ones"""
+    mode = f"local:{graph.key}" if graph is not None else routing_mode
+    return mode + '|' + ';'.join(f"{lat:.6f},{lon:.6f}" for lat, lon in dest_coords)
+
+def moved(row):
+    """True if the last scrape changed a field that decides where the listing is"""
+    changed = (row.get('Changed Fields') or '').split(', ')
+    return any(field in changed for field in location_fields)
+
+def skip_rows(rows, route_columns, geocode_status, route_status, reason):
+    for row in rows:
+        if geocode_status:
+            row['Latitude'] = row['Longitude'] = None
+            row['Geocode Status'] = geocode_status
+        for cols in route_columns:
+            for col in cols:
+                row[col] = None
+        row['Route Status'] = route_status
+    metrics.count('rows_skipped', len(rows), stage='drive_time', reason=reason)
+
+def beyond_radius(located, dest_coords):
+    """Mask of (row, coords) pairs too far in a straight line from the first destination to pass max_drive_time"""
+    limit = filters.rules.get('max_drive_time')
+    if not located or limit is None:
+        return [False] * len(located)
+    lats, lons = (np.array([coords[i] for _, coords in located], dtype=np.float64) for i in (0, 1))
+    miles = haversine_meters(lats, lons, dest_coords[0][0], dest_coords[0][1]) / 1609.34
+    return list(miles > limit / 60 * max_road_speed_mph)
+
+def add_drive_times(rows, dest_coords, route_columns, existing_data, graph=None, routes=None):
+    """Fill coordinates and drive times for a chunk of rows, geocoding and routing them together.
+
+    routes, a KeyIndex by coordinate_key, keeps the routes found for each grid cell
+    across chunks; listings in one cell (e.g. units of one building) are routed once.
+    """
+    routes = routes if routes is not None else KeyIndex(coordinate_key)
+    basis = route_basis(dest_coords, graph)
+    pending = []
+    for row in rows:
+        # Reuse this listing's previous results if every route succeeded against the
+        # same destinations and routing mode and it has not moved
+        existing_row = existing_data.get(row[KEY])
+        if existing_row and not moved(row) and existing_row.get('Route Status') == 'ok' and \
+                existing_row.get('Route Basis') == basis and \
+                all(existing_row.get(col) is not None for cols in route_columns for col in cols):
+            row.update(existing_row)
+            metrics.count('cache_hits', cache='route')
+            continue
+        metrics.count('cache_misses', cache='route')
+        row['Route Basis'] = basis
+        pending.append(row)
+
+    if prefilter:
+        keep = filters.passes(pending, filters.listing_rules)
+        skip_rows([row for row, kept in zip(pending, keep) if not kept], route_columns, 'skipped', 'skipped', 'rules')
+        pending = [row for row, kept in zip(pending, keep) if kept]
+
+    # If no existing data or data was invalid, process new requests
+    geocoded = geocode_addresses(full_address(row) for row in pending if not listed_coordinates(row))
+
+    located = []
+    for row in pending:
+        listed = listed_coordinates(row)
+        origin_coords = listed or geocoded.get(full_address(row))[1]
+        for cols in route_columns:
+            for col in cols:
+                row[col] = None
+        if origin_coords:
+            row['Latitude'], row['Longitude'] = origin_coords
+            row['Geocode Status'] = 'listed' if listed else 'geocoded'
+            located.append((row, origin_coords))
+        else:
+            row['Latitude'] = row['Longitude'] = None
+            row['Geocode Status'] = 'failed'
+            row['Route Status'] = 'not_geocoded'
+
+    if prefilter:
+        far = beyond_radius(located, dest_coords)
+        skip_rows([row for (row, _), out in zip(located, far) if out], route_columns, None, 'out_of_range', 'radius')
+        located = [pair for pair, out in zip(located, far) if not out]
+
+    unrouted = KeyIndex(coordinate_key)
+    for _, coords in located:
+        if coords not in routes:
+            unrouted.put(coords, coords)
+    origins = unrouted.values()
+    for coords, row_routes in zip(origins, get_drive_times(origins, dest_coords, graph)):
+        routes.put(coords, row_routes)
+
+    for row, coords in located:
+        _, row_routes = routes.get(coords)
+        row['Route Status'] = 'ok'
+        for route, (time_col, dist_col) in zip(row_routes, route_columns):
+            if route:
+                row[time_col] = route['duration_mins']
+                row[dist_col] = route['distance_miles']
             else:
-                row['Coordinates'] = "Geocoding failed"
-                row['Drive Time (mins)'] = "Geocoding failed"
-                row['Distance (miles)'] = "Geocoding failed"
-            
-            writer.writerow(row)
+                row['Route Status'] = 'failed'
+
+def stream_drive_times(rows, store):
+    """Set up stage 2 over a stream of rows; returns (owned columns, generator of rows).
+
+    Raises RuntimeError if a destination cannot be geocoded.
+    """
+    route_columns = destination_columns()
+    columns = owned_columns(route_columns)
+
+    # Geocode the destinations once
+    dest_coords = []
+    for name, address in destinations.items():
+        coords = geocode_address(address)
+        if not coords:
+            raise RuntimeError(f"Failed to geocode destination address for {name}: {address}")
+        dest_coords.append(coords)
+    graph = RoadGraph.load(road_graph_extract, road_graph_path) if routing_mode == 'local' else None
+    routes = KeyIndex(coordinate_key)
+
+    def generate():
+        # Rows are geocoded and routed a chunk at a time, as they arrive
+        pending = iter(rows)
+        while True:
+            chunk = list(islice(pending, geocode_batch_size))
+            if not chunk:
+                break
+            existing_data = store.get((row[KEY] for row in chunk), columns)
+            add_drive_times(chunk, dest_coords, route_columns, existing_data, graph, routes)
+            yield from chunk
+
+    return columns, generate()
+
+def calculate_free_drive_times(store):
+    started = time.monotonic()
+    try:
+        columns, rows = stream_drive_times(store.read(pipeline.input_columns('drive_time')), store)
+    except RuntimeError as e:
+        print(e)
+        return
+
+    store.ensure_columns(columns)
+    processed = store.write_stream(rows, columns)
+    elapsed = time.monotonic() - started
+    print(f"Processed {processed} rows in {elapsed:.1f}s ({processed / max(elapsed, 1e-9):.1f} rows/s)")
 
 if __name__ == "__main__":
-    input_filename = "1_properties.csv"
-    output_filename = "2_properties_w_drive.csv"
-    calculate_free_drive_times(input_filename, output_filename)
-    print(f"Drive time calculations complete. Results saved to {output_filename}")
\ No newline at end of file
+    store = PropertyStore()
+    calculate_free_drive_times(store)
+    print(f"Drive time calculations complete. Results saved to {store.path}")
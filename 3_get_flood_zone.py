@@ -1,22 +1,32 @@
-import pandas as pd
+import importlib
 import requests
-import time
-import os
+from itertools import islice
+from canonical_keys import KeyIndex, cell_center, coordinate_key
+from flood_index import FloodIndex
+from http_client import client
+from metrics import metrics
+import pipeline
+from property_store import KEY, PropertyStore
 
-# Load CSV
-df = pd.read_csv('2_properties_w_drive.csv')
+filters = importlib.import_module('4_filter_properties')
 
-# Check if previous output file exists
-output_file = '3_properties_w_flood.csv'
-previous_results = {}
-if os.path.exists(output_file):
-    try:
-        previous_df = pd.read_csv(output_file)
-        if 'Coordinates' in previous_df.columns and 'Flood Zone' in previous_df.columns:
-            previous_results = dict(zip(previous_df['Coordinates'], previous_df['Flood Zone']))
-            print(f"Loaded {len(previous_results)} previous flood zone results")
-    except Exception as e:
-        print(f"Could not read previous output file: {e}")
+# Configuration
+# 'online' queries FEMA's NFHL MapServer per property; 'local' answers from an
+# NFHL flood hazard extract (GeoJSON or shapefile) covering the search area
+flood_mode = 'online'
+nfhl_extract = 'nfhl_flood_hazard.geojson'
+flood_index_path = 'flood_index.npz'
+flood_workers = 8  # FEMA queries in flight at once (paced by the hazards.fema.gov rate limit)
+flood_chunk_size = 100  # Rows looked up together
+prefilter = True  # Skip lookups for listings the filter rules in 4_filter_properties.py reject anyway
+
+# Columns this stage owns in the property store
+columns = {
+    'Flood Zone': 'TEXT',
+    'Flood Status': 'TEXT',  # 'ok', 'error', 'no_coordinates' or 'skipped'
+    'Flood Latitude': 'REAL',  # Point the zone was looked up at: the center of the listing's grid cell
+    'Flood Longitude': 'REAL'
+}
 
 # FEMA NFHL FeatureServer (Flood Hazard Zones layer 28)
 FEMA_URL = "https://hazards.fema.gov/arcgis/rest/services/public/NFHL/MapServer/28/query"
@@ -32,7 +42,7 @@ def get_flood_zone(lat, lon):
             'returnGeometry': 'false',
             'f': 'json'
         }
-        response = requests.get(FEMA_URL, params=params)
+        response = client.get(FEMA_URL, params=params)
         response.raise_for_status()
         data = response.json()
         if data.get('features'):
@@ -40,39 +50,108 @@ def get_flood_zone(lat, lon):
             return f"{zone.get('FLD_ZONE')} ({zone.get('ZONE_SUBTY', 'N/A')})"
         else:
             return "Not in mapped flood zone"
-    except Exception as e:
+    except (requests.RequestException, ValueError) as e:
         return f"Error: {e}"
 
-# Loop over properties and query FEMA
-flood_zones = []
-total_queries = 0
-new_queries = 0
-
-for coord in df['Coordinates']:
-    if coord in previous_results:
-        # Use cached result
-        flood_zones.append(previous_results[coord])
-        total_queries += 0  # No new query needed
-    elif isinstance(coord, str) and "," in coord:
-        try:
-            lat, lon = map(float, coord.strip().split(","))
-            zone = get_flood_zone(lat, lon)
-            flood_zones.append(zone)
-            total_queries += 1
-            new_queries += 1
-            time.sleep(0.2)  # Respectful delay for the API
-        except ValueError:
-            flood_zones.append("Invalid coordinates")
-            total_queries += 0
+def add_flood_zones(rows, previous_results, index=None, zones=None):
+    """Set Flood Zone and Flood Status on a chunk of rows; returns the number of new FEMA queries.
+
+    Points are quantized to the canonical coordinate grid and each cell is looked up
+    once, at its center. zones, a KeyIndex by coordinate_key, keeps the zone of each
+    cell across chunks.
+    """
+    zones = zones if zones is not None else KeyIndex(coordinate_key)
+    lookups = []
+    for row in rows:
+        cell = coordinate_key((row.get('Latitude'), row.get('Longitude')))
+        row['Flood Latitude'], row['Flood Longitude'] = cell_center(cell) if cell else (None, None)
+        previous = previous_results.get(row[KEY])
+        if cell is None:
+            row['Flood Zone'], row['Flood Status'] = None, 'no_coordinates'
+        elif previous and previous.get('Flood Status') == 'ok' and \
+                coordinate_key((previous.get('Flood Latitude'), previous.get('Flood Longitude'))) == cell:
+            # Same listing in the same grid cell as last run: reuse its result
+            row['Flood Zone'], row['Flood Status'] = previous['Flood Zone'], 'ok'
+            metrics.count('cache_hits', cache='flood')
+        else:
+            lookups.append(row)
+
+    if prefilter:
+        # Listings the filter would drop for their price, beds, ZIP code or drive time are not looked up
+        keep = filters.passes(lookups, filters.listing_rules + ['max_drive_time'])
+        for row in (row for row, kept in zip(lookups, keep) if not kept):
+            row['Flood Zone'], row['Flood Status'] = None, 'skipped'
+        metrics.count('rows_skipped', int((~keep).sum()), stage='flood_zone', reason='rules')
+        lookups = [row for row, kept in zip(lookups, keep) if kept]
+
+    # Nearby listings in one cell share a lookup, with each other and with earlier chunks
+    waiting = {}  # Cell -> rows waiting on its lookup
+    for row in lookups:
+        point = (row['Flood Latitude'], row['Flood Longitude'])
+        found, zone = zones.get(point)
+        if found:
+            row['Flood Zone'], row['Flood Status'] = zone, 'ok'
+            metrics.count('cache_hits', cache='flood')
+        else:
+            waiting.setdefault(coordinate_key(point), []).append(row)
+    points = [cell_center(cell) for cell in waiting]
+    metrics.count('cache_misses', len(points), cache='flood')
+
+    if index is not None:
+        # Local mode: one vectorized pass over the extract
+        results = index.lookup([lat for lat, _ in points], [lon for _, lon in points])
+        new_queries = 0
     else:
-        flood_zones.append("Missing coordinates")
-        total_queries += 0
+        # Query FEMA concurrently; the shared client keeps within its rate limit
+        results = client.map(lambda point: get_flood_zone(*point), points, flood_workers)
+        new_queries = len(points)
+
+    for point, zone, group in zip(points, results, waiting.values()):
+        if zone.startswith('Error'):
+            print(f"Flood zone lookup failed for {', '.join(row[KEY] for row in group)}: {zone}")
+            for row in group:
+                row['Flood Zone'], row['Flood Status'] = None, 'error'
+            continue
+        zones.put(point, zone)
+        for row in group:
+            row['Flood Zone'], row['Flood Status'] = zone, 'ok'
+    return new_queries
+
+def stream_flood_zones(rows, store, stats=None):
+    """Set up stage 3 over a stream of rows; returns (owned columns, generator of rows).
+
+    stats, if given, is a dict that receives running 'processed' and 'new_queries' counts.
+    """
+    stats = stats if stats is not None else {}
+    stats.update(processed=0, new_queries=0)
+    index = FloodIndex.load(nfhl_extract, flood_index_path) if flood_mode == 'local' else None
+    zones = KeyIndex(coordinate_key)
+
+    def generate():
+        pending = iter(rows)
+        while True:
+            chunk = list(islice(pending, flood_chunk_size))
+            if not chunk:
+                break
+            # The extract answers everything locally, so only online mode reuses old results
+            previous_results = {} if index is not None else store.get(
+                (row[KEY] for row in chunk), list(columns))
+            stats['new_queries'] += add_flood_zones(chunk, previous_results, index, zones)
+            stats['processed'] += len(chunk)
+            yield from chunk
+
+    return columns, generate()
+
+def update_flood_zones(store):
+    stats = {}
+    owned, rows = stream_flood_zones(store.read(pipeline.input_columns('flood_zone')), store, stats)
+    store.ensure_columns(owned)
+    store.write_stream(rows, owned)
 
-# Save results
-df['Flood Zone'] = flood_zones
-df.to_csv(output_file, index=False)
+    print(f"Flood zone info saved to '{store.path}'.")
+    print(f"Total properties processed: {stats['processed']}")
+    print(f"Queries saved using cache: {stats['processed'] - stats['new_queries']}")
+    print(f"New queries made: {stats['new_queries']}")
 
-print(f"Flood zone info saved to '{output_file}'.")
-print(f"Total properties processed: {len(df)}")
-print(f"Queries saved using cache: {len(df) - new_queries}")
-print(f"New queries made: {new_queries}")
\ No newline at end of file
+if __name__ == "__main__":
+    update_flood_zones(PropertyStore())
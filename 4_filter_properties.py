@@ -1,29 +1,154 @@
-import csv
-
-def filter_properties(input_file, output_file):
-    with open(input_file, mode='r', newline='', encoding='utf-8') as infile, \
-         open(output_file, mode='w', newline='', encoding='utf-8') as outfile:
-        
-        reader = csv.DictReader(infile)
-        fieldnames = reader.fieldnames
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-        writer.writeheader()
-        
-        for row in reader:
-
-            # Check flood zone (exclude if starts with 'AE')
-            if row['Flood Zone'].startswith('AE'):
-                continue
-            
-            # Check drive time (exclude if > 25 mins)
-            drive_time = float(row['Drive Time (mins)'])
-            if drive_time > 25:
-                continue
-                
-            # If passed both checks, write to output
-            writer.writerow(row)
-                
-
-
-# Usage example:
-filter_properties('3_properties_w_flood.csv', '4_filtered_properties.csv')
\ No newline at end of file
+from itertools import islice
+import numpy as np
+import pandas as pd
+import pipeline
+from photo_store import parse_photo_source, queue_sync, wait_for_syncs
+from property_store import KEY, PropertyStore
+
+# Filter criteria. Set a rule to None to turn it off.
+rules = {
+    'max_drive_time': 25,  # Minutes to the first destination
+    'excluded_flood_zones': ['AE'],  # FEMA zone codes to drop, e.g. ['A', 'AE', 'VE']
+    'max_price_per_sqft': None,
+    'min_beds': None,
+    'zip_codes': None  # Allow-list of ZIP codes, e.g. ['70001', '70005']
+}
+
+# Rules that let a listing through when the value they test is unknown (e.g. a
+# failed route or flood lookup). Every other rule rejects unknown values.
+keep_unknown = set()
+
+# Rules that only need scraped fields. Stages 2 and 3 check these (and stage 3 also
+# max_drive_time) before geocoding, routing or looking up flood zones, so listings the
+# filter will reject anyway cost no requests.
+listing_rules = ['max_price_per_sqft', 'min_beds', 'zip_codes']
+
+fetch_photos = True  # Download photos for listings that pass (see photo_downloads in 1_get_properties.py)
+
+chunk_size = 5000  # Rows filtered together when streaming
+
+# Columns this stage owns in the property store
+columns = {
+    'Passed Filter': 'INTEGER'
+}
+
+def numeric(df, column):
+    return pd.to_numeric(df[column], errors='coerce') if column in df else pd.Series(np.nan, index=df.index)
+
+def flood_zone_codes(df):
+    """FLD_ZONE code from labels like 'AE (None)'; NaN when the zone is unknown"""
+    labels = df['Flood Zone'] if 'Flood Zone' in df else pd.Series(np.nan, index=df.index, dtype=object)
+    codes = labels.astype('string').str.split(' (', n=1, regex=False).str[0]
+    return codes.where(labels.notna())
+
+def drive_times(df):
+    """Drive time to the first destination; infinite where stage 2 found it beyond any drive of the limit"""
+    times = numeric(df, 'Drive Time (mins)')
+    if 'Route Status' in df:
+        times = times.mask(df['Route Status'].eq('out_of_range').to_numpy(dtype=bool), np.inf)
+    return times
+
+# Each rule: (column values for the test, predicate on known values)
+rule_tests = {
+    'max_drive_time': lambda df, limit: (drive_times(df), lambda v: v <= limit),
+    'excluded_flood_zones': lambda df, zones: (flood_zone_codes(df), lambda v: ~v.isin(list(zones))),
+    'max_price_per_sqft': lambda df, limit: (numeric(df, 'Price') / numeric(df, 'Square Feet').where(lambda s: s > 0),
+                                             lambda v: v <= limit),
+    'min_beds': lambda df, minimum: (numeric(df, 'Beds'), lambda v: v >= minimum),
+    # ZIP+4 codes ('70001-1234') are compared by their five-digit ZIP
+    'zip_codes': lambda df, allowed: (df['ZIP Code'].astype('string').str.strip().str[:5] if 'ZIP Code' in df else
+                                      pd.Series(pd.NA, index=df.index, dtype='string'),
+                                      lambda v: v.isin([str(z).strip()[:5] for z in allowed]))
+}
+
+def compile_rules(criteria=None, unknown=None):
+    """Turn a rule set into a list of (name, predicate) where predicate(df) is a boolean keep-mask"""
+    criteria = rules if criteria is None else criteria
+    unknown = keep_unknown if unknown is None else unknown
+    compiled = []
+    for name, setting in criteria.items():
+        if setting is None:
+            continue
+        if name not in rule_tests:
+            raise ValueError(f"Unknown filter rule: {name}")
+
+        def predicate(df, name=name, setting=setting):
+            values, test = rule_tests[name](df, setting)
+            known = values.notna().to_numpy()
+            passed = np.zeros(len(df), dtype=bool)
+            passed[known] = test(values[known]).to_numpy(dtype=bool)
+            if name in unknown:
+                passed |= ~known
+            return pd.Series(passed, index=df.index)
+
+        compiled.append((name, predicate))
+    return compiled
+
+def apply_rules(df, compiled):
+    """Evaluate compiled rules over a DataFrame; returns (keep mask, rows removed per rule).
+
+    A row is counted against the first rule that rejects it, so the counts add up
+    to the number of rows removed.
+    """
+    keep = pd.Series(True, index=df.index)
+    removed = {}
+    for name, predicate in compiled:
+        passed = predicate(df)
+        removed[name] = int((keep & ~passed).sum())
+        keep &= passed
+    return keep, removed
+
+def passes(rows, names):
+    """Keep-mask over a list of row dicts for the named rules only, as the full filter would judge them"""
+    if not rows:
+        return np.zeros(0, dtype=bool)
+    compiled = compile_rules({name: rules.get(name) for name in names})
+    keep, _ = apply_rules(pd.DataFrame.from_records(rows), compiled)
+    return keep.to_numpy(dtype=bool)
+
+def print_report(total, kept, removed):
+    print(f"Filtered {total} properties: {kept} passed")
+    for name, count in removed.items():
+        print(f"  {name}: removed {count}")
+
+def stream_filtered(rows, criteria=None, report=None):
+    """Set up stage 4 over a stream of rows; returns (owned columns, generator of rows).
+
+    Rows are filtered in chunks of chunk_size with vectorized predicates. report, if
+    given, is a dict that receives running 'total', 'kept' and 'removed' counts.
+    """
+    compiled = compile_rules(criteria)
+    report = report if report is not None else {}
+    report.update(total=0, kept=0, removed={name: 0 for name, _ in compiled})
+
+    def generate():
+        pending = iter(rows)
+        while True:
+            chunk = list(islice(pending, chunk_size))
+            if not chunk:
+                break
+            keep, removed = apply_rules(pd.DataFrame.from_records(chunk), compiled)
+            for row, passed in zip(chunk, keep):
+                row['Passed Filter'] = int(passed)
+                photos = parse_photo_source(row.get('Photo Source')) if passed and fetch_photos else None
+                if photos:
+                    queue_sync(row[KEY], *photos)
+            report['total'] += len(chunk)
+            report['kept'] += int(keep.sum())
+            for name, count in removed.items():
+                report['removed'][name] += count
+            yield from chunk
+        wait_for_syncs()
+
+    return columns, generate()
+
+def filter_properties(store):
+    report = {}
+    owned, rows = stream_filtered(store.read(pipeline.input_columns('filter')), report=report)
+    store.ensure_columns(owned)
+    store.write_stream(rows, owned)
+    print_report(report['total'], report['kept'], report['removed'])
+
+
+if __name__ == '__main__':
+    filter_properties(PropertyStore())
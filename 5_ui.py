@@ -2,10 +2,30 @@ import tkinter as tk
 from tkinter import ttk
 from io import BytesIO
 import requests
-from PIL import Image, ImageTk
+from PIL import ImageTk
+import numpy as np
 import pandas as pd
 import os
+import queue
+import time
 import tkinter.font as tkfont
+import pipeline
+from listing_history import ListingHistory
+from photo_store import legacy_folder, listing_photos, parse_photo_source, queue_sync
+from property_store import KEY, PropertyStore
+from thumbnail_cache import ThumbnailLoader, gallery_size, popup_size
+
+# Store bookkeeping columns that are not useful in the table
+hidden_columns = ['Listing Key', 'Active', 'Passed Filter', 'Listed Latitude', 'Listed Longitude',
+                  'Flood Latitude', 'Flood Longitude', 'Changed Fields', 'Photo Source', 'Route Basis']
+
+# Table settings
+width_sample = 20  # Longest values per column measured when sizing columns
+filter_delay_ms = 200  # Wait after the last keystroke before re-filtering
+
+# Gallery settings
+prefetch_neighbors = 1  # Listings on each side of the selection whose thumbnails are decoded ahead
+thumbnail_poll_ms = 30
 
 class PropertyViewer:
     def __init__(self, root):
@@ -13,36 +33,108 @@ class PropertyViewer:
         self.root.title("Property Viewer")
         self.root.geometry("1400x900")  # Increased window size
 
-        self.df = pd.read_csv('filtered_properties.csv')
+        store = PropertyStore()
+        self.history = ListingHistory(store)
+        # Columns in pipeline stage order, not the order stages happened to add them to the table
+        self.df = store.frame(pipeline.column_order(), where='Active = 1 AND "Passed Filter" = 1').reset_index(drop=True)
         self.sort_column = None
         self.sort_descending = False
+        self.sort_orders = {}  # Column -> (row positions of known values in ascending order, positions of missing values)
+        self.column_widths = {}
+
+        # The table only ever holds the visible rows; view lists the df positions
+        # of the rows that pass the filter, in display order, and top is the
+        # first one on screen.
+        self.view = np.arange(len(self.df))
+        self.top = 0
+        self.visible_rows = 1
+        self.row_items = []
+        self.selected_row = None
+        self.filter_job = None
+
+        self.thumbnails = ThumbnailLoader()
+        self.thumbnail_results = queue.Queue()
+        self.gallery_generation = 0
+        self.photo_fetches = set()  # Listing keys whose photos are being downloaded
 
         self.filter_url_columns()
+        self.prepare_indexes()
         self.create_widgets()
 
     def filter_url_columns(self):
         url_keywords = ['url', 'link', 'http', 'image']
-        self.display_columns = [col for col in self.df.columns 
-                                if not any(keyword in col.lower() for keyword in url_keywords)]
+        self.display_columns = [col for col in self.df.columns
+                                if col not in hidden_columns
+                                and not any(keyword in col.lower() for keyword in url_keywords)]
         self.zip_column = next((col for col in self.df.columns if 'zip' in col.lower()), None)
         self.street_column = next((col for col in self.df.columns if 'street' in col.lower()), None)
 
+    def prepare_indexes(self):
+        """Precompute the arrays the table renders, searches and range-filters from"""
+        shown = self.df[self.display_columns]
+        self.text_columns = {col: self.display_text(shown[col]) for col in self.display_columns}
+        self.cells = np.column_stack([self.text_columns[col].to_numpy(dtype=object) for col in self.display_columns]) \
+            if self.display_columns else np.empty((len(self.df), 0), dtype=object)
+
+        search = pd.Series('', index=self.df.index)
+        for col in self.display_columns:
+            search = search + ' ' + self.text_columns[col]
+        self.search_text = search.str.lower()
+
+        self.numeric_columns = {col: shown[col].to_numpy(dtype=np.float64) for col in self.display_columns
+                                if pd.api.types.is_numeric_dtype(shown[col])}
+
+    @staticmethod
+    def display_text(values):
+        """Column values as text; whole-number floats drop the '.0' (Beds 3, not 3.0) and missing values are blank"""
+        text = values.astype(str)
+        if pd.api.types.is_float_dtype(values):
+            whole = np.isfinite(values) & (values % 1 == 0)
+            text[whole] = values[whole].astype(np.int64).astype(str)
+        return text.where(values.notna(), '')
+
     def create_widgets(self):
+        filter_frame = ttk.Frame(self.root)
+        filter_frame.pack(fill=tk.X, padx=10, pady=(10, 0))
+
+        ttk.Label(filter_frame, text="Search:").pack(side=tk.LEFT)
+        self.search_var = tk.StringVar()
+        ttk.Entry(filter_frame, textvariable=self.search_var, width=40).pack(side=tk.LEFT, padx=(5, 15))
+
+        self.range_column_var = tk.StringVar()
+        self.range_min_var = tk.StringVar()
+        self.range_max_var = tk.StringVar()
+        ttk.Combobox(filter_frame, textvariable=self.range_column_var, values=list(self.numeric_columns),
+                     state='readonly', width=25).pack(side=tk.LEFT)
+        ttk.Label(filter_frame, text="from").pack(side=tk.LEFT, padx=5)
+        ttk.Entry(filter_frame, textvariable=self.range_min_var, width=10).pack(side=tk.LEFT)
+        ttk.Label(filter_frame, text="to").pack(side=tk.LEFT, padx=5)
+        ttk.Entry(filter_frame, textvariable=self.range_max_var, width=10).pack(side=tk.LEFT)
+        self.count_label = ttk.Label(filter_frame)
+        self.count_label.pack(side=tk.RIGHT)
+        for var in (self.search_var, self.range_column_var, self.range_min_var, self.range_max_var):
+            var.trace_add('write', self.schedule_filter)
+
         main_frame = ttk.Frame(self.root)
         main_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
 
-        self.tree = ttk.Treeview(main_frame, columns=self.display_columns, show="headings")
+        self.tree = ttk.Treeview(main_frame, columns=self.display_columns, show="headings", selectmode='browse')
         for col in self.display_columns:
             self.tree.heading(col, text=col, command=lambda _col=col: self.sort_by_column(_col))
-            self.tree.column(col, width=100, stretch=False)
-        self.load_treeview_data()
         self.auto_fit_columns()
 
-        scrollbar = ttk.Scrollbar(main_frame, orient=tk.VERTICAL, command=self.tree.yview)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.scrollbar = ttk.Scrollbar(main_frame, orient=tk.VERTICAL, command=self.on_scroll)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         self.tree.bind("<<TreeviewSelect>>", self.on_select)
+        self.tree.bind("<Configure>", self.on_resize)
+        self.tree.bind("<MouseWheel>", lambda e: self.scroll_by(-1 if e.delta > 0 else 1, 3))
+        self.tree.bind("<Button-4>", lambda e: self.scroll_by(-1, 3))
+        self.tree.bind("<Button-5>", lambda e: self.scroll_by(1, 3))
+        self.tree.bind("<Up>", lambda e: self.move_selection(-1))
+        self.tree.bind("<Down>", lambda e: self.move_selection(1))
+        self.tree.bind("<Prior>", lambda e: self.scroll_by(-1, self.visible_rows))
+        self.tree.bind("<Next>", lambda e: self.scroll_by(1, self.visible_rows))
 
         detail_frame = ttk.LabelFrame(self.root, text="Property Details")
         detail_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
@@ -66,93 +158,260 @@ class PropertyViewer:
         self.details_text.pack(fill=tk.BOTH, expand=True)
 
         self.image_refs = []
+        self.render()
+        self.poll_thumbnails()
 
     def update_scroll_region(self, event=None):
         self.canvas.configure(scrollregion=self.canvas.bbox("all"))
 
     def auto_fit_columns(self):
+        """Size columns from the heading and the longest few values, measured once and cached"""
+        if not self.column_widths:
+            heading_font = tkfont.nametofont('TkHeadingFont')
+            cell_font = tkfont.nametofont('TkDefaultFont')
+            for col in self.display_columns:
+                lengths = self.text_columns[col].str.len()
+                longest = self.text_columns[col][lengths.nlargest(width_sample).index].unique()
+                width = max([heading_font.measure(col)] + [cell_font.measure(text) for text in longest])
+                self.column_widths[col] = width + 20
         for col in self.display_columns:
-            self.tree.column(col, width=tk.font.Font().measure(col.title()))
-        self.root.update_idletasks()
-        for col in self.display_columns:
-            max_width = tk.font.Font().measure(col.title())
-            for row in self.df[col]:
-                width = tk.font.Font().measure(str(row))
-                if width > max_width:
-                    max_width = width
-            self.tree.column(col, width=max_width + 20)
+            self.tree.column(col, width=self.column_widths[col], stretch=False)
+
+    def render(self):
+        """Show the rows of the view starting at top in the table's fixed set of row items"""
+        count = min(self.visible_rows, len(self.view) - self.top)
+        while len(self.row_items) < count:
+            self.row_items.append(self.tree.insert("", tk.END))
+        while len(self.row_items) > count:
+            self.tree.delete(self.row_items.pop())
+
+        rows = self.view[self.top:self.top + count]
+        for item, row in zip(self.row_items, rows):
+            self.tree.item(item, values=list(self.cells[row]))
+
+        # Keep the highlight on the selected listing, not on the row slot
+        slots = np.flatnonzero(rows == self.selected_row)
+        if len(slots):
+            self.tree.selection_set(self.row_items[slots[0]])
+            self.tree.focus(self.row_items[slots[0]])
+        elif self.tree.selection():
+            self.tree.selection_remove(self.tree.selection())
+
+        total = max(len(self.view), 1)
+        self.scrollbar.set(self.top / total, (self.top + count) / total)
+        self.count_label.configure(text=f"{len(self.view)} of {len(self.df)} properties")
+
+    def scroll_to(self, top):
+        self.top = int(max(0, min(top, len(self.view) - self.visible_rows)))
+        self.render()
+
+    def scroll_by(self, direction, rows):
+        self.scroll_to(self.top + direction * rows)
+        return "break"
+
+    def on_scroll(self, action, amount, unit=None):
+        if action == 'moveto':
+            self.scroll_to(float(amount) * len(self.view))
+        elif action == 'scroll':
+            self.scroll_by(int(amount), self.visible_rows if unit == 'pages' else 1)
+
+    def on_resize(self, event):
+        row_height = int(ttk.Style().lookup('Treeview', 'rowheight') or 20)
+        visible_rows = max(1, event.height // row_height - 1)  # Less one row for the headings
+        if visible_rows != self.visible_rows:
+            self.visible_rows = visible_rows
+            self.scroll_to(self.top)
+
+    def move_selection(self, step):
+        """Arrow keys move the selection through the whole view, scrolling at the edges"""
+        if not len(self.view):
+            return "break"
+        positions = np.flatnonzero(self.view == self.selected_row)
+        position = positions[0] + step if len(positions) else self.top
+        position = max(0, min(position, len(self.view) - 1))
+        self.select_row(self.view[position])
+        if position < self.top:
+            self.scroll_to(position)
+        elif position >= self.top + self.visible_rows:
+            self.scroll_to(position - self.visible_rows + 1)
+        else:
+            self.render()
+        return "break"
 
     def on_select(self, event):
         selected = self.tree.focus()
-        if not selected:
+        if not selected or selected not in self.row_items:
             return
-        values = self.tree.item(selected)['values']
+        row = self.view[self.top + self.row_items.index(selected)]
+        if row != self.selected_row:
+            self.select_row(row)
+
+    def select_row(self, row):
+        self.selected_row = row
         self.details_text.delete(1.0, tk.END)
-        details = "\n".join(f"{col}: {val}" for col, val in zip(self.display_columns, values))
+        details = "\n".join(f"{col}: {val}" for col, val in zip(self.display_columns, self.cells[row]))
+        timeline = self.history.price_timeline(self.df.iloc[row][KEY])
+        if len(timeline) > 1:
+            details += "\nPrice history: " + " -> ".join(
+                f"{time.strftime('%Y-%m-%d', time.localtime(observed))} ${price:,.0f}" for observed, price in timeline)
         self.details_text.insert(tk.END, details)
 
-        selected_idx = self.tree.index(selected)
-        zip_code = str(self.df.iloc[selected_idx][self.zip_column])
-        street = str(self.df.iloc[selected_idx][self.street_column])
-        folder_name = f"Photos/{zip_code}_{self.clean_filename(street)}"
-        self.display_gallery(folder_name)
-
-    def display_gallery(self, folder_path):
+        image_files = self.image_files(row)
+        if not image_files and self.fetch_photos(row):
+            self.show_gallery_message("Downloading photos...")
+        else:
+            self.display_gallery(image_files)
+
+        # Decode the neighbours' thumbnails now so moving the selection paints at once
+        positions = np.flatnonzero(self.view == row)
+        if len(positions):
+            for offset in range(1, prefetch_neighbors + 1):
+                for position in (positions[0] + offset, positions[0] - offset):
+                    if 0 <= position < len(self.view):
+                        self.thumbnails.prefetch(self.image_files(self.view[position]), gallery_size)
+
+    def image_files(self, row):
+        """A listing's photos from its manifest, or from its folder if it was scraped before manifests"""
+        paths = listing_photos(self.df.iloc[row][KEY])
+        if paths:
+            return paths
+        folder_path = legacy_folder(self.df.iloc[row][self.zip_column], self.df.iloc[row][self.street_column])
+        if not os.path.isdir(folder_path):
+            return []
+        return [os.path.join(folder_path, f) for f in sorted(os.listdir(folder_path))
+                if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+
+    def fetch_photos(self, row):
+        """Download photos of a listing that has none on disk yet; returns False if there is nothing to fetch"""
+        key = self.df.iloc[row][KEY]
+        photos = parse_photo_source(self.df.iloc[row].get('Photo Source'))
+        if not photos:
+            return False
+        if key not in self.photo_fetches:
+            self.photo_fetches.add(key)
+            job = queue_sync(key, *photos)
+            job.add_done_callback(lambda job: self.deliver(self.photos_fetched, row)(None))
+        return True
+
+    def photos_fetched(self, row, _):
+        self.photo_fetches.discard(self.df.iloc[row][KEY])
+        if row == self.selected_row:
+            self.display_gallery(self.image_files(row))
+
+    def clear_gallery(self):
         for widget in self.gallery_frame.winfo_children():
             widget.destroy()
         self.image_refs.clear()
+        self.gallery_generation += 1
 
-        if not os.path.isdir(folder_path):
-            print(f"No image folder found: {folder_path}")
-            return
+    def show_gallery_message(self, text):
+        self.clear_gallery()
+        tk.Label(self.gallery_frame, text=text).pack(side=tk.LEFT, padx=10, pady=10)
+        self.update_scroll_region()
+
+    def display_gallery(self, image_files):
+        self.clear_gallery()
 
-        image_files = sorted([f for f in os.listdir(folder_path) if f.lower().endswith(('.jpg', '.jpeg', '.png'))])
         if not image_files:
-            print(f"No images found in: {folder_path}")
+            print(f"No images found for: {self.df.iloc[self.selected_row][self.street_column]}")
             return
 
-        for img_file in image_files:
-            try:
-                img_path = os.path.join(folder_path, img_file)
-                img = Image.open(img_path)
-                img.thumbnail((280, 280))  # Display size
-                photo = ImageTk.PhotoImage(img)
+        # Placeholders keep the gallery order while thumbnails arrive from the decoder threads
+        for img_path in image_files:
+            label = tk.Label(self.gallery_frame, text="Loading...", width=20)
+            label.image_path = img_path  # Save path for the event
+            label.bind("<Button-1>", self.open_image_popup)
+            label.pack(side=tk.LEFT, padx=10, pady=10)
+            self.thumbnails.request(img_path, gallery_size, self.deliver(self.show_thumbnail, label,
+                                                                         self.gallery_generation))
 
-                label = tk.Label(self.gallery_frame, image=photo)
-                label.image_path = img_path  # Save path for the event
-                label.bind("<Button-1>", self.open_image_popup)
-                label.pack(side=tk.LEFT, padx=10, pady=10)
+        self.update_scroll_region()
 
-                self.image_refs.append(photo)
-            except Exception as e:
-                print(f"Error loading {img_file}: {e}")
+    def deliver(self, handler, *args):
+        """Callback for the loader's threads that queues the result for the Tk main loop"""
+        return lambda img: self.thumbnail_results.put((handler, args, img))
 
+    def poll_thumbnails(self):
+        while True:
+            try:
+                handler, args, img = self.thumbnail_results.get_nowait()
+            except queue.Empty:
+                break
+            handler(*args, img)
+        self.root.after(thumbnail_poll_ms, self.poll_thumbnails)
+
+    def show_thumbnail(self, label, generation, img):
+        if generation != self.gallery_generation or not label.winfo_exists():
+            return  # The selection moved on
+        if img is None:
+            label.configure(text="Unavailable")
+            return
+        photo = ImageTk.PhotoImage(img)
+        label.configure(image=photo, text='', width=0)
+        self.image_refs.append(photo)
         self.update_scroll_region()
 
     def open_image_popup(self, event):
-        image_path = event.widget.image_path
-        try:
-            top = tk.Toplevel(self.root)
-            top.title("Image Viewer")
-
-            img = Image.open(image_path)
-            img = img.resize((min(800, img.width), min(600, img.height)))
-            photo = ImageTk.PhotoImage(img)
-
-            label = tk.Label(top, image=photo)
-            label.image = photo  # Keep reference
-            label.pack(padx=10, pady=10)
-        except Exception as e:
-            print(f"Error opening image: {e}")
-
-    def clean_filename(self, text):
-        return "".join(c for c in text if c.isalnum() or c in (' ', '_', '-')).rstrip()
-
-    def load_treeview_data(self):
-        for row in self.tree.get_children():
-            self.tree.delete(row)
-        for _, row in self.df.iterrows():
-            self.tree.insert("", tk.END, values=list(row[self.display_columns]))
+        top = tk.Toplevel(self.root)
+        top.title("Image Viewer")
+        label = tk.Label(top, text="Loading...")
+        label.pack(padx=10, pady=10)
+        self.thumbnails.request(event.widget.image_path, popup_size, self.deliver(self.show_popup_image, label))
+
+    def show_popup_image(self, label, img):
+        if not label.winfo_exists():
+            return
+        if img is None:
+            label.configure(text="Error opening image")
+            return
+        photo = ImageTk.PhotoImage(img)
+        label.configure(image=photo, text='')
+        label.image = photo  # Keep reference
+
+    def sort_order(self, col):
+        """Cached stable sort of the whole table by col, with missing values kept apart"""
+        if col not in self.sort_orders:
+            values = self.df[col]
+            order = values.sort_values(kind='mergesort').index.to_numpy()
+            known = values.notna().to_numpy()[order]
+            self.sort_orders[col] = (order[known], order[~known])
+        return self.sort_orders[col]
+
+    def filter_mask(self):
+        """Boolean mask over all rows for the search text and the range filter"""
+        mask = np.ones(len(self.df), dtype=bool)
+        for term in self.search_var.get().lower().split():
+            mask &= self.search_text.str.contains(term, regex=False).to_numpy()
+
+        col = self.range_column_var.get()
+        if col in self.numeric_columns:
+            values = self.numeric_columns[col]
+            for text, keep in ((self.range_min_var.get(), lambda v, bound: v >= bound),
+                               (self.range_max_var.get(), lambda v, bound: v <= bound)):
+                try:
+                    bound = float(text.replace(',', '').replace('$', ''))
+                except ValueError:
+                    continue  # Empty or partly typed bound
+                with np.errstate(invalid='ignore'):
+                    mask &= keep(values, bound)
+        return mask
+
+    def schedule_filter(self, *args):
+        if self.filter_job:
+            self.root.after_cancel(self.filter_job)
+        self.filter_job = self.root.after(filter_delay_ms, self.update_view)
+
+    def update_view(self):
+        """Rebuild the view from the cached sort order and the filter mask"""
+        self.filter_job = None
+        if self.sort_column is None:
+            order = np.arange(len(self.df))
+        else:
+            known, missing = self.sort_order(self.sort_column)
+            # Reversing keeps missing values last in both directions
+            order = np.concatenate([known[::-1] if self.sort_descending else known, missing])
+        self.view = order[self.filter_mask()[order]]
+        self.scroll_to(self.top)
 
     def sort_by_column(self, col):
         if self.sort_column == col:
@@ -161,9 +420,11 @@ class PropertyViewer:
             self.sort_column = col
             self.sort_descending = False
 
-        self.df = self.df.sort_values(by=col, ascending=not self.sort_descending, kind='mergesort')
-        self.load_treeview_data()
-        self.auto_fit_columns()
+        for name in self.display_columns:
+            arrow = (' \u25bc' if self.sort_descending else ' \u25b2') if name == col else ''
+            self.tree.heading(name, text=name + arrow)
+        self.top = 0
+        self.update_view()
 
 if __name__ == "__main__":
     root = tk.Tk()
@@ -0,0 +1,139 @@
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import http_client
+import photo_store
+from geocode_cache import GeocodeCache
+from property_store import PropertyStore
+from replay_server import ReplayServer, check_road_graph, flood_extract, road_extract
+
+# Configuration
+default_sizes = [100, 500, 1000]
+local_rate_limit = (1000, 100)  # Requests per second and burst for the replay server
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    """Silence stdout at the file descriptor level, so search worker processes are silenced too"""
+    if not enabled:
+        yield
+        return
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, 'w') as devnull:
+        os.dup2(devnull.fileno(), 1)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            os.dup2(saved, 1)
+            os.close(saved)
+
+def configure(modules, server, flood_mode, batch_geocoding, routing_mode, source='html'):
+    """Point every stage at the replay server, with fresh caches in the current directory.
+
+    source picks the search backend: 'html' result pages or the 'json' GIS feed.
+    """
+    m1, m2, m3, _ = modules
+    http_client.rate_limits['127.0.0.1'] = local_rate_limit
+    search_url = server.url + ('/stingray/api/gis' if source == 'json' else '/search')
+    m1.searches = [{'name': 'Benchmark', 'source': source, 'url': search_url}]
+    photo_store.cdn_url = server.url
+    m2.geocode_url = server.url + '/arcgis/findAddressCandidates'
+    m2.batch_geocode_url = server.url + '/arcgis/geocodeAddresses'
+    m2.use_batch_geocoding = batch_geocoding
+    m2.osrm_url = server.url + '/osrm'
+    m2.routing_mode = routing_mode
+    if routing_mode == 'local':
+        check_road_graph()  # Fails fast if the router gets a small, known network wrong
+        m2.road_graph_extract = 'road_graph.geojson'
+        with open(m2.road_graph_extract, 'w') as f:
+            json.dump(road_extract(), f)
+    m2.geocode_cache = GeocodeCache()
+    m3.FEMA_URL = server.url + '/fema/query'
+    m3.flood_mode = flood_mode
+    if flood_mode == 'local':
+        with open(m3.nfhl_extract, 'w') as f:
+            json.dump(flood_extract(), f)
+
+def run_size(modules, size, args):
+    m1, m2, m3, m4 = modules
+    server = ReplayServer(listings=size, photos_per_listing=args.photos, latency=args.latency,
+                          error_rate=args.error_rate).start()
+    workdir = tempfile.TemporaryDirectory(prefix=f'benchmark_{size}_')
+    cwd = os.getcwd()
+    os.chdir(workdir.name)
+    try:
+        configure(modules, server, args.flood_mode, args.batch_geocoding, args.routing_mode, args.source)
+        store = PropertyStore()
+        stages = [
+            ('scrape', m1.scrape_redfin),
+            ('drive_time', lambda: m2.calculate_free_drive_times(store)),
+            ('flood_zone', lambda: m3.update_flood_zones(store)),
+            ('filter', lambda: m4.filter_properties(store)),
+        ]
+        results = []
+        for name, run in stages:
+            before = server.snapshot()
+            started = time.perf_counter()
+            with quiet(not args.verbose):
+                run()
+            seconds = time.perf_counter() - started
+            after = server.snapshot()
+            rows = sum(1 for _ in store.read([]))
+            results.append({
+                'size': size,
+                'stage': name,
+                'rows': rows,
+                'seconds': seconds,
+                'rows_per_second': rows / seconds if seconds else None,
+                'requests': {service: count for service, count in (after[0] - before[0]).items() if count},
+                'injected_errors': sum((after[1] - before[1]).values()),
+                'bytes': sum((after[2] - before[2]).values())
+            })
+        return results
+    finally:
+        os.chdir(cwd)
+        server.stop()
+        workdir.cleanup()
+
+def print_results(results):
+    print(f"{'size':>6} {'stage':<11} {'rows':>6} {'seconds':>8} {'rows/s':>9} {'errors':>6} {'MB':>7}  requests")
+    for result in results:
+        requests = ', '.join(f"{service} {count}" for service, count in sorted(result['requests'].items()))
+        print(f"{result['size']:>6} {result['stage']:<11} {result['rows']:>6} {result['seconds']:>8.2f} "
+              f"{result['rows_per_second'] or 0:>9.1f} {result['injected_errors']:>6} "
+              f"{result['bytes'] / 1e6:>7.2f}  {requests}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages offline against a local replay server")
+    parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes, help="listings per run")
+    parser.add_argument('--photos', type=int, default=5, help="photos per listing")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to each response (+/-50%%)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered 503")
+    parser.add_argument('--source', choices=['html', 'json'], default='html',
+                        help="scrape the HTML result pages or the GIS search feed")
+    parser.add_argument('--flood-mode', choices=['online', 'local'], default='online')
+    parser.add_argument('--routing-mode', choices=['osrm', 'local'], default='osrm')
+    parser.add_argument('--batch-geocoding', action='store_true', help="use the multi-address geocoding endpoint")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--verbose', action='store_true', help="show the stages' own output")
+    args = parser.parse_args()
+
+    modules = [importlib.import_module(name) for name in
+               ('1_get_properties', '2_get_drive_time', '3_get_flood_zone', '4_filter_properties')]
+    results = []
+    for size in args.sizes:
+        results += run_size(modules, size, args)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
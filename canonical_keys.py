@@ -0,0 +1,97 @@
+import math
+import re
+import threading
+
+# Configuration
+coordinate_grid = 0.0001  # Degrees (about 11 m); points in the same grid cell share cached lookups
+
+# Common USPS suffix and direction abbreviations, so "123 North Main Street" and
+# "123 N Main St" share one key
+abbreviations = {
+    'street': 'st', 'avenue': 'ave', 'boulevard': 'blvd', 'drive': 'dr', 'road': 'rd',
+    'lane': 'ln', 'court': 'ct', 'place': 'pl', 'terrace': 'ter', 'parkway': 'pkwy',
+    'highway': 'hwy', 'circle': 'cir', 'square': 'sq', 'trail': 'trl', 'expressway': 'expy',
+    'north': 'n', 'south': 's', 'east': 'e', 'west': 'w',
+    'northeast': 'ne', 'northwest': 'nw', 'southeast': 'se', 'southwest': 'sw'
+}
+# Words that introduce a unit number; "Apt 4B", "Suite 4B" and "#4B" all become "unit 4b"
+unit_designators = {'apartment', 'apt', 'unit', 'suite', 'ste', 'room', 'rm', '#'}
+
+def normalize_address(address):
+    """Reduce an address to a stable key: lowercase, no punctuation, abbreviated words, one unit form, five-digit ZIP"""
+    text = str(address).lower().replace('#', ' # ')
+    text = re.sub(r'\b(\d{5})-\d{4}\b', r'\1', text)  # ZIP+4, so "LA 70001-1234" and "LA 70001" share a key
+    text = re.sub(r'[^\w\s#]', ' ', text)
+    words = []
+    for word in text.split():
+        if word in unit_designators:
+            if words and words[-1] == 'unit':
+                continue  # "Apt #4B"
+            word = 'unit'
+        words.append(abbreviations.get(word, word))
+    return ' '.join(words)
+
+def address_key(street, city, state, zip_code):
+    """Normalized address of a listing; ZIP+4 codes are cut to five digits"""
+    zip_code = str(zip_code or '').strip()[:5]
+    return normalize_address(f"{street or ''} {city or ''} {state or ''} {zip_code}")
+
+def listing_key(row):
+    """Stable key for a listing: Redfin's home id from the URL, else the normalized address"""
+    match = re.search(r'/home/(\d+)', row.get('URL') or '')
+    if match:
+        return f"redfin:{match.group(1)}"
+    return 'address:' + address_key(row.get('Street'), row.get('City'), row.get('State'), row.get('ZIP Code'))
+
+def coordinate_key(coords, grid=None):
+    """Grid cell (row, column) of a (lat, lon) point, or None if either is missing"""
+    grid = grid or coordinate_grid
+    try:
+        lat, lon = float(coords[0]), float(coords[1])
+    except (TypeError, ValueError, IndexError):
+        return None
+    if math.isnan(lat) or math.isnan(lon):
+        return None
+    return (math.floor(lat / grid), math.floor(lon / grid))
+
+def cell_center(key, grid=None):
+    """(lat, lon) at the middle of a coordinate_key cell, rounded so the same cell always gives the same text"""
+    grid = grid or coordinate_grid
+    digits = max(0, -math.floor(math.log10(grid))) + 2
+    return (round((key[0] + 0.5) * grid, digits), round((key[1] + 0.5) * grid, digits))
+
+class KeyIndex:
+    """In-memory hash index from canonical keys to values, safe to share between threads.
+
+    key is the function that turns an item (an address, a (lat, lon) point, ...)
+    into its canonical key, so equivalent items find the same entry.
+    """
+
+    def __init__(self, key=None):
+        self.key = key or (lambda item: item)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, item):
+        """(found, value) for an item"""
+        key = self.key(item)
+        with self.lock:
+            if key in self.entries:
+                return True, self.entries[key]
+        return False, None
+
+    def put(self, item, value):
+        key = self.key(item)
+        with self.lock:
+            self.entries[key] = value
+
+    def values(self):
+        with self.lock:
+            return list(self.entries.values())
+
+    def __contains__(self, item):
+        return self.get(item)[0]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
@@ -0,0 +1,183 @@
+import json
+import os
+import numpy as np
+
+# Configuration
+node_capacity = 16  # Children per R-tree node
+index_version = 1
+
+def read_features(path):
+    """Yield (properties, polygons) from a GeoJSON or shapefile flood hazard extract.
+
+    Each polygon is a list of rings and each ring a list of (lon, lat) points.
+    """
+    if path.lower().endswith('.shp'):
+        try:
+            import shapefile  # pyshp, only needed for shapefile extracts
+        except ImportError:
+            raise ImportError("Reading .shp extracts requires pyshp (pip install pyshp)")
+        with shapefile.Reader(path) as reader:
+            for record in reader.iterShapeRecords():
+                geometry = record.shape.__geo_interface__
+                yield record.record.as_dict(), geometry_polygons(geometry)
+        return
+
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    for feature in data.get('features', []):
+        if feature.get('geometry'):
+            yield feature.get('properties') or {}, geometry_polygons(feature['geometry'])
+
+def geometry_polygons(geometry):
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    if geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    return []
+
+def zone_label(properties):
+    """Format a flood zone the same way get_flood_zone does for FEMA's query results"""
+    return f"{properties.get('FLD_ZONE')} ({properties.get('ZONE_SUBTY', 'N/A')})"
+
+def str_order(boxes):
+    """Sort-Tile-Recursive ordering: vertical slices by x center, then by y center within each slice"""
+    count = len(boxes)
+    if count == 0:
+        return np.arange(0)
+    cx = (boxes[:, 0] + boxes[:, 2]) / 2
+    cy = (boxes[:, 1] + boxes[:, 3]) / 2
+    leaves = int(np.ceil(count / node_capacity))
+    slice_size = int(np.ceil(np.sqrt(leaves))) * node_capacity
+
+    order = np.argsort(cx, kind='stable')
+    for start in range(0, count, slice_size):
+        part = order[start:start + slice_size]
+        order[start:start + slice_size] = part[np.argsort(cy[part], kind='stable')]
+    return order
+
+def build_index(extract_path):
+    """Load a flood hazard extract and pack it into flat arrays with an STR R-tree"""
+    labels, boxes = [], []
+    edges, edge_counts = [], []
+    for properties, polygons in read_features(extract_path):
+        rings = [np.asarray(ring, dtype=np.float64)[:, :2] for polygon in polygons for ring in polygon]
+        rings = [ring for ring in rings if len(ring) >= 3]
+        if not rings:
+            continue
+        points = np.concatenate(rings)
+        boxes.append((points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()))
+        # Every ring edge as (x1, y1, x2, y2); holes and parts are handled by the even-odd rule
+        ring_edges = [np.hstack([ring, np.roll(ring, -1, axis=0)]) for ring in rings]
+        edges.append(np.concatenate(ring_edges))
+        edge_counts.append(len(edges[-1]))
+        labels.append(zone_label(properties))
+
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    order = str_order(boxes)
+    edges = [edges[i] for i in order]
+    edge_counts = np.asarray(edge_counts, dtype=np.int64)[order]
+
+    # Level 0 holds the polygons themselves; each level above groups node_capacity children
+    levels = [boxes[order]]
+    while len(levels[-1]) > 1:
+        child = levels[-1]
+        pad = -len(child) % node_capacity
+        padded = np.vstack([child, np.tile([np.inf, np.inf, -np.inf, -np.inf], (pad, 1))])
+        groups = padded.reshape(-1, node_capacity, 4)
+        levels.append(np.column_stack([groups[:, :, 0].min(1), groups[:, :, 1].min(1),
+                                       groups[:, :, 2].max(1), groups[:, :, 3].max(1)]))
+
+    arrays = {
+        'version': np.array(index_version),
+        'feature_order': order,
+        'labels': np.asarray(labels, dtype=str)[order] if labels else np.array([], dtype=str),
+        'edges': np.concatenate(edges) if edges else np.empty((0, 4)),
+        'edge_offsets': np.concatenate([[0], np.cumsum(edge_counts)]),
+        'level_count': np.array(len(levels))
+    }
+    for i, level in enumerate(levels):
+        arrays[f'level_{i}'] = level
+    return FloodIndex(arrays)
+
+class FloodIndex:
+    """Flood hazard polygons packed into numpy arrays for batch point lookups"""
+
+    def __init__(self, arrays):
+        self.labels = arrays['labels']
+        self.feature_order = arrays['feature_order']
+        self.edges = arrays['edges']
+        self.edge_offsets = arrays['edge_offsets']
+        self.levels = [arrays[f'level_{i}'] for i in range(int(arrays['level_count']))]
+        self.arrays = arrays
+
+    @classmethod
+    def load(cls, extract_path, index_path):
+        """Load the serialized index, rebuilding it when the extract is newer.
+
+        A valid index is used as it is when the extract is no longer there.
+        """
+        if os.path.exists(index_path) and (not os.path.exists(extract_path) or
+                                           os.path.getmtime(index_path) >= os.path.getmtime(extract_path)):
+            with np.load(index_path) as data:
+                arrays = {key: data[key] for key in data.files}
+            if int(arrays['version']) == index_version:
+                return cls(arrays)
+
+        print(f"Building flood zone index from {extract_path}...")
+        index = build_index(extract_path)
+        np.savez(index_path, **index.arrays)
+        return index
+
+    def candidates(self, lats, lons):
+        """Walk the tree for all points at once; returns (point, polygon) pairs whose boxes contain the point"""
+        points = np.arange(len(lats))
+        nodes = np.zeros(len(lats), dtype=np.int64)
+        for depth in range(len(self.levels) - 1, -1, -1):
+            boxes = self.levels[depth]
+            if depth < len(self.levels) - 1:
+                # Expand every surviving (point, node) pair to the node's children
+                points = np.repeat(points, node_capacity)
+                nodes = (np.repeat(nodes, node_capacity) * node_capacity
+                         + np.tile(np.arange(node_capacity), len(nodes)))
+                keep = nodes < len(boxes)
+                points, nodes = points[keep], nodes[keep]
+            box = boxes[nodes]
+            inside = ((lons[points] >= box[:, 0]) & (lons[points] <= box[:, 2]) &
+                      (lats[points] >= box[:, 1]) & (lats[points] <= box[:, 3]))
+            points, nodes = points[inside], nodes[inside]
+        return points, nodes
+
+    def lookup(self, lats, lons, missing="Not in mapped flood zone"):
+        """Flood zone label for each point, matching get_flood_zone's output"""
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        result = np.full(len(lats), missing, dtype=object)
+        matched_feature = np.full(len(lats), np.iinfo(np.int64).max)
+        if len(self.labels) == 0 or len(lats) == 0:
+            return list(result)
+
+        points, polygons = self.candidates(lats, lons)
+        order = np.argsort(polygons, kind='stable')
+        points, polygons = points[order], polygons[order]
+        bounds = np.flatnonzero(np.diff(polygons)) + 1
+
+        for group in np.split(np.arange(len(polygons)), bounds):
+            if len(group) == 0:
+                continue
+            polygon = polygons[group[0]]
+            pts = points[group]
+            x1, y1, x2, y2 = self.edges[self.edge_offsets[polygon]:self.edge_offsets[polygon + 1]].T
+            px, py = lons[pts][:, None], lats[pts][:, None]
+
+            # Even-odd ray casting: count edge crossings to the right of each point
+            straddles = (y1 > py) != (y2 > py)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cross_x = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+            inside = np.count_nonzero(straddles & (px < cross_x), axis=1) % 2 == 1
+
+            # Overlapping polygons: keep the one listed first in the extract, like FEMA's first feature
+            feature = self.feature_order[polygon]
+            hit = pts[inside & (feature < matched_feature[pts])]
+            result[hit] = self.labels[polygon]
+            matched_feature[hit] = feature
+        return list(result)
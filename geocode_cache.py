@@ -0,0 +1,88 @@
+import sqlite3
+import threading
+import time
+from canonical_keys import KeyIndex, normalize_address
+
+# Configuration
+cache_path = 'geocode_cache.sqlite'
+failure_ttl = 6 * 60 * 60  # Seconds before an address with no match is retried; doubles per repeat failure
+max_failure_ttl = 30 * 24 * 60 * 60
+
+class GeocodeCache:
+    """On-disk geocode results shared across runs and searches"""
+
+    def __init__(self, path=cache_path):
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+        self.memory = KeyIndex(normalize_address)  # Successful lookups already read or written this run
+
+    @property
+    def conn(self):
+        # Opened on first use (always under self.lock), so creating the cache writes no file
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            with self.connection:
+                self.connection.execute("""
+                    CREATE TABLE IF NOT EXISTS geocodes (
+                        address_key TEXT PRIMARY KEY,
+                        lat REAL,
+                        lon REAL,
+                        failures INTEGER NOT NULL DEFAULT 0,
+                        retry_after REAL,
+                        updated REAL NOT NULL
+                    )
+                """)
+        return self.connection
+
+    def get(self, address):
+        """Return (found, coords). found is False when the address should be looked up again."""
+        found, coords = self.memory.get(address)
+        if found:
+            return True, coords
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT lat, lon, retry_after FROM geocodes WHERE address_key = ?",
+                (normalize_address(address),)
+            ).fetchone()
+        if row is None:
+            return False, None
+        lat, lon, retry_after = row
+        if lat is not None:
+            self.memory.put(address, (lat, lon))
+            return True, (lat, lon)
+        if retry_after is not None and retry_after > time.time():
+            return True, None  # Recent failure, still within its backoff window
+        return False, None
+
+    def put(self, address, coords):
+        """Store a success indefinitely, or a failure with an exponentially growing TTL"""
+        key = normalize_address(address)
+        now = time.time()
+        if coords:
+            self.memory.put(address, tuple(coords))
+        with self.lock, self.conn:
+            if coords:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO geocodes (address_key, lat, lon, failures, retry_after, updated) "
+                    "VALUES (?, ?, ?, 0, NULL, ?)",
+                    (key, coords[0], coords[1], now)
+                )
+                return
+
+            row = self.conn.execute(
+                "SELECT failures FROM geocodes WHERE address_key = ?", (key,)
+            ).fetchone()
+            failures = (row[0] if row else 0) + 1
+            ttl = min(failure_ttl * 2 ** (failures - 1), max_failure_ttl)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO geocodes (address_key, lat, lon, failures, retry_after, updated) "
+                "VALUES (?, NULL, NULL, ?, ?, ?)",
+                (key, failures, now + ttl, now)
+            )
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
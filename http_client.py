@@ -0,0 +1,130 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import metrics
+
+# Configuration
+# Requests per second and burst size allowed for each upstream host. Hosts not
+# listed here use default_rate_limit.
+rate_limits = {
+    'www.redfin.com': (1, 1),
+    'ssl.cdn-redfin.com': (20, 20),
+    'geocode.arcgis.com': (10, 10),
+    'router.project-osrm.org': (1, 1),
+    'hazards.fema.gov': (5, 5),
+}
+default_rate_limit = (10, 10)
+connections_per_host = 8  # Keep-alive connections held open to each host
+request_timeout = 30  # Seconds, used when a call does not pass its own timeout
+max_retries = 4
+backoff_base = 0.5  # Seconds before the first retry; doubles on each retry
+retry_statuses = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """Allows rate requests per second on average, with bursts of up to burst requests"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available; returns the seconds spent waiting"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+def retry_after(response, attempt):
+    """Seconds to wait before retrying: the server's Retry-After if given, else exponential backoff"""
+    header = response.headers.get('Retry-After') if response is not None else None
+    if header:
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(header).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return backoff_base * 2 ** attempt * random.uniform(0.8, 1.2)
+
+class HttpClient:
+    """Pooled, rate-limited HTTP client with timeouts and retries, shared by all stages"""
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=connections_per_host, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.buckets = {}
+        self.buckets_lock = threading.Lock()
+
+    def bucket(self, host):
+        with self.buckets_lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(*rate_limits.get(host, default_rate_limit))
+            return self.buckets[host]
+
+    def request(self, method, url, **kwargs):
+        """Send a request, waiting for the host's rate limit and retrying 429/5xx and connection errors.
+
+        Other responses (including 4xx) are returned as-is; requests.RequestException is
+        raised once retries are exhausted.
+        """
+        kwargs.setdefault('timeout', request_timeout)
+        host = urlsplit(url).hostname
+        bucket = self.bucket(host)
+
+        for attempt in range(max_retries + 1):
+            if attempt:
+                metrics.count('http_retries', host=host)
+            metrics.count('http_throttled_seconds', bucket.acquire(), host=host)
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.count('http_errors', host=host, error=type(e).__name__)
+                if attempt == max_retries:
+                    raise
+                time.sleep(retry_after(None, attempt))
+                continue
+            finally:
+                metrics.observe('http_request_seconds', time.perf_counter() - started, host=host)
+
+            metrics.count('http_requests', host=host, status=f"{response.status_code // 100}xx")
+            if response.status_code not in retry_statuses or attempt == max_retries:
+                return response
+            response.close()
+            time.sleep(retry_after(response, attempt))
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def map(self, fn, items, workers=8):
+        """Run fn over items on a thread pool, returning results in order"""
+        items = list(items)
+        if len(items) <= 1 or workers <= 1:
+            return [fn(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+            return list(executor.map(fn, items))
+
+client = HttpClient()
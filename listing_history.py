@@ -0,0 +1,123 @@
+import json
+import time
+from property_store import KEY, coerce, quote, write_batch_size
+
+# Configuration
+# Scraped fields compared between runs; a difference in any of them makes a listing 'changed'
+tracked_columns = {
+    'Street': 'TEXT',
+    'City': 'TEXT',
+    'State': 'TEXT',
+    'ZIP Code': 'TEXT',
+    'Price': 'REAL',
+    'Beds': 'REAL',
+    'Baths': 'REAL',
+    'Square Feet': 'REAL',
+    'Listed Latitude': 'REAL',
+    'Listed Longitude': 'REAL'
+}
+price_tolerance = 0.5  # Dollars; smaller price differences are rounding, not a price change
+
+def differs(name, old, new):
+    if tracked_columns[name] == 'REAL' and old is not None and new is not None:
+        return abs(old - new) > (price_tolerance if name == 'Price' else 1e-6)
+    return old != new
+
+class ListingHistory:
+    """Scrape snapshots, per-listing changes and price timelines, kept in the property store's database.
+
+    Each scrape is compared with the listings already in the store: a listing is
+    'new' the first time it is seen, 'relisted' if it was inactive, 'changed' if a
+    tracked field differs, and 'removed' if a previously active listing was not
+    found. Listings that did not change are not recorded.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        with store.conn:
+            store.conn.execute("CREATE TABLE IF NOT EXISTS scrapes (id INTEGER PRIMARY KEY, started REAL, finished REAL, "
+                               "new INTEGER, relisted INTEGER, changed INTEGER, unchanged INTEGER, removed INTEGER)")
+            store.conn.execute("CREATE TABLE IF NOT EXISTS listing_changes (scrape_id INTEGER, listing_key TEXT, "
+                               "change TEXT, fields TEXT)")
+            store.conn.execute("CREATE INDEX IF NOT EXISTS listing_changes_key ON listing_changes (listing_key)")
+            store.conn.execute("CREATE TABLE IF NOT EXISTS price_history (listing_key TEXT, observed REAL, price REAL)")
+            store.conn.execute("CREATE INDEX IF NOT EXISTS price_history_key ON price_history (listing_key)")
+
+    def begin(self):
+        """Snapshot the listings as they stand before a scrape"""
+        columns = [name for name in list(tracked_columns) + ['First Seen'] if name in self.store.column_types()]
+        self.previous = {row[KEY]: row for row in self.store.read(columns + ['Active'], where="1 = 1")}
+        self.seen = set()
+        self.started = time.time()
+        self.counts = dict.fromkeys(['new', 'relisted', 'changed', 'unchanged', 'removed'], 0)
+        self.changes, self.prices = [], []
+        with self.store.conn:
+            self.scrape_id = self.store.conn.execute("INSERT INTO scrapes (started) VALUES (?)",
+                                                     (self.started,)).lastrowid
+
+    def observe(self, row):
+        """Classify a scraped row against the snapshot, record the change and set its history columns"""
+        key = row[KEY]
+        self.seen.add(key)
+        previous = self.previous.get(key)
+        values = {name: coerce(row.get(name), sql_type) for name, sql_type in tracked_columns.items()}
+
+        if previous is None:
+            change, fields = 'new', []
+        else:
+            fields = [name for name in tracked_columns
+                      if name in previous and differs(name, previous[name], values[name])]
+            change = 'relisted' if not previous['Active'] else 'changed' if fields else 'unchanged'
+
+        self.counts[change] += 1
+        row['Listing Change'] = change
+        row['Changed Fields'] = ', '.join(fields)
+        row['First Seen'] = (previous or {}).get('First Seen') or time.strftime('%Y-%m-%d', time.localtime(self.started))
+        if change == 'unchanged':
+            return change
+
+        # Changes record old and new values of the fields that changed, or every value for a new listing
+        detail = {name: [previous[name], values[name]] for name in fields} if previous else values
+        self.changes.append((self.scrape_id, key, change, json.dumps(detail)))
+        if values['Price'] is not None and (change in ('new', 'relisted') or 'Price' in fields):
+            self.prices.append((key, self.started, values['Price']))
+        if len(self.changes) >= write_batch_size:
+            self.flush()
+        return change
+
+    def flush(self):
+        with self.store.conn:
+            self.store.conn.executemany("INSERT INTO listing_changes VALUES (?, ?, ?, ?)", self.changes)
+            self.store.conn.executemany("INSERT INTO price_history VALUES (?, ?, ?)", self.prices)
+        self.changes, self.prices = [], []
+
+    def finish(self):
+        """After a complete scrape: deactivate and record the listings that disappeared, and the scrape's totals.
+
+        Returns the counts. Removed listings stay in the store but drop out of downstream stages.
+        """
+        removed = [key for key, row in self.previous.items() if row['Active'] and key not in self.seen]
+        self.counts['removed'] = len(removed)
+        self.flush()
+        with self.store.conn:
+            self.store.conn.executemany(f"UPDATE listings SET Active = 0 WHERE {quote(KEY)} = ?",
+                                        ((key,) for key in removed))
+            self.store.conn.executemany("INSERT INTO listing_changes VALUES (?, ?, 'removed', NULL)",
+                                        ((self.scrape_id, key) for key in removed))
+            self.store.conn.execute("UPDATE scrapes SET finished = ?, new = ?, relisted = ?, changed = ?, "
+                                    "unchanged = ?, removed = ? WHERE id = ?",
+                                    (time.time(), *self.counts.values(), self.scrape_id))
+        return self.counts
+
+    def abort(self):
+        """After a failed scrape: keep the changes observed so far, but record no removals and no totals.
+
+        Listings the scrape did not reach stay active, and the scrape is left unfinished
+        in the scrapes table.
+        """
+        self.flush()
+
+    def price_timeline(self, key):
+        """[(timestamp, price)] for a listing, oldest first"""
+        return self.store.conn.execute("SELECT observed, price FROM price_history WHERE listing_key = ? "
+                                       "ORDER BY observed", (key,)).fetchall()
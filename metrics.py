@@ -0,0 +1,167 @@
+import json
+import math
+import os
+import threading
+import time
+
+# Configuration
+latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]  # Seconds; upper bounds of the latency histogram buckets
+prometheus_prefix = 'property_searcher_'
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Metrics:
+    """Counters, gauges and latency histograms that every stage reports into.
+
+    Each metric is identified by a name plus labels, e.g.
+    metrics.count('http_requests', host='www.redfin.com').
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}  # key -> [count per bucket (last is +Inf), sum, count]
+
+    def count(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [[0] * (len(latency_buckets) + 1), 0.0, 0])
+            histogram[0][next((i for i, bound in enumerate(latency_buckets) if value <= bound),
+                              len(latency_buckets))] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def snapshot(self):
+        """Plain-data copy, e.g. to send from a worker process to be merged into the parent's metrics"""
+        with self.lock:
+            return {'counters': dict(self.counters), 'gauges': dict(self.gauges),
+                    'histograms': {key: [list(h[0]), h[1], h[2]] for key, h in self.histograms.items()}}
+
+    def merge(self, snapshot):
+        with self.lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(snapshot['gauges'])
+            for key, (buckets, total, count) in snapshot['histograms'].items():
+                histogram = self.histograms.setdefault(key, [[0] * (len(latency_buckets) + 1), 0.0, 0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += total
+                histogram[2] += count
+
+    def total(self, name, **labels):
+        """Sum of a counter over every label set that includes the given labels"""
+        wanted = set(label_key(labels))
+        with self.lock:
+            return sum(value for (metric, key), value in self.counters.items()
+                       if metric == name and wanted <= set(key))
+
+    def summary(self):
+        """Per-stage, per-host and per-cache figures for spotting the bottleneck of a run"""
+        snapshot = self.snapshot()
+        stages, hosts, caches = {}, {}, {}
+        for (name, labels), value in list(snapshot['gauges'].items()) + list(snapshot['counters'].items()):
+            labels = dict(labels)
+            if 'stage' in labels and name.startswith('stage_'):
+                stages.setdefault(labels['stage'], {})[name[len('stage_'):]] = value
+            elif 'host' in labels and name.startswith('http_'):
+                entry = hosts.setdefault(labels['host'], {})
+                entry[name[len('http_'):]] = entry.get(name[len('http_'):], 0) + value
+            elif 'cache' in labels and name.startswith('cache_'):
+                caches.setdefault(labels['cache'], {'hits': 0, 'misses': 0})[name[len('cache_'):]] += value
+
+        for (name, labels), (_, total, count) in snapshot['histograms'].items():
+            labels = dict(labels)
+            if name == 'http_request_seconds' and count:
+                hosts.setdefault(labels['host'], {})['mean_seconds'] = total / count
+                hosts[labels['host']]['p95_seconds'] = self.quantile(name, 0.95, host=labels['host'])
+        for cache in caches.values():
+            lookups = cache['hits'] + cache['misses']
+            cache['hit_ratio'] = cache['hits'] / lookups if lookups else None
+        return {'stages': stages, 'hosts': hosts, 'caches': caches}
+
+    def quantile(self, name, q, **labels):
+        """Upper bucket bound below which a fraction q of the observations fall"""
+        with self.lock:
+            buckets, _, count = self.histograms.get((name, label_key(labels)), ([], 0.0, 0))
+            buckets = list(buckets)
+        seen = 0
+        for bound, bucket in zip(latency_buckets + [math.inf], buckets):
+            seen += bucket
+            if count and seen >= q * count:
+                return bound
+        return None
+
+    def report(self):
+        """The run report: summary plus every metric, as JSON-serializable data"""
+        snapshot = self.snapshot()
+        return {
+            'started': self.started,
+            'finished': time.time(),
+            'summary': self.summary(),
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in sorted(snapshot['counters'].items())],
+            'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                       for (name, labels), value in sorted(snapshot['gauges'].items())],
+            'histograms': [{'name': name, 'labels': dict(labels), 'sum': total, 'count': count,
+                            'buckets': dict(zip([str(bound) for bound in latency_buckets] + ['+Inf'], buckets))}
+                           for (name, labels), (buckets, total, count) in sorted(snapshot['histograms'].items())]
+        }
+
+    def write_report(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.report(), f, indent=2, default=str)
+        os.replace(tmp_path, path)
+
+    def prometheus_text(self):
+        """Metrics in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        for kind, values, suffix in (('counter', snapshot['counters'], '_total'), ('gauge', snapshot['gauges'], '')):
+            for name in sorted({name for name, _ in values}):
+                full_name = prometheus_prefix + name + suffix
+                lines.append(f"# TYPE {full_name} {kind}")
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name and value is not None:
+                        lines.append(f"{full_name}{format_labels(labels)} {value}")
+
+        for name in sorted({name for name, _ in snapshot['histograms']}):
+            full_name = prometheus_prefix + name
+            lines.append(f"# TYPE {full_name} histogram")
+            for (metric, labels), (buckets, total, count) in sorted(snapshot['histograms'].items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip([str(bound) for bound in latency_buckets] + ['+Inf'], buckets):
+                    cumulative += bucket
+                    lines.append(f"{full_name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{full_name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{full_name}_count{format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+metrics = Metrics()
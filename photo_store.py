@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+import requests
+from canonical_keys import KeyIndex
+from http_client import client
+from metrics import metrics
+
+# Configuration
+photo_base_dir = 'Photos'
+objects_dir = os.path.join(photo_base_dir, 'objects')  # Image files named by the SHA-256 of their content
+manifests_dir = os.path.join(photo_base_dir, 'manifests')  # One JSON manifest per listing key
+cdn_url = "https://ssl.cdn-redfin.com"
+max_photos = 30  # Try up to 30 images per listing
+recheck_after_days = 14  # Probe past a finished set again after this long, in case photos were added
+download_headers = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}  # Sent when the caller passes no headers of its own
+sync_workers = 8  # Listings downloading photos at the same time
+max_pending_syncs = 64  # Listings queued for photos before queue_sync waits
+
+sync_executor = ThreadPoolExecutor(max_workers=sync_workers)
+sync_slots = threading.BoundedSemaphore(max_pending_syncs)
+sync_jobs = set()
+sync_jobs_lock = threading.Lock()
+# Manifests synced this run by photo set, so another listing with the same photos
+# (a duplicate or relisted property under a new key) starts from them
+synced_sets = KeyIndex(lambda photo_set: tuple(str(part) for part in photo_set))
+
+def clean_filename(text):
+    """Strip characters that are not allowed in file names (used for the pre-manifest folder layout)"""
+    return re.sub(r'[<>:"/\\|?*]', '', str(text).strip())
+
+def legacy_folder(zip_code, street):
+    """Folder photos were saved in before the content-addressed store"""
+    return os.path.join(photo_base_dir, f"{zip_code}_{clean_filename(street)}")
+
+def object_path(digest):
+    return os.path.join(objects_dir, digest[:2], digest + '.jpg')
+
+def manifest_path(key):
+    return os.path.join(manifests_dir, re.sub(r'[^\w.-]', '_', key) + '.json')
+
+def photo_url(photo_set, index):
+    region, folder, base_id, top_id = photo_set
+    if index == 0:
+        return f"{cdn_url}/photo/{region}/bigphoto/{folder}/{base_id}_{top_id}.jpg"
+    return f"{cdn_url}/photo/{region}/bigphoto/{folder}/{base_id}_{index}_{top_id}.jpg"
+
+def photo_source(photo_set, photo_count=None):
+    """Text stored with a listing so its photos can be fetched later, without scraping it again"""
+    return json.dumps({'photo_set': [str(part) for part in photo_set], 'count': photo_count})
+
+def parse_photo_source(text):
+    """(photo set, photo count) from photo_source's text, or None"""
+    try:
+        source = json.loads(text)
+        return source['photo_set'], source.get('count')
+    except (TypeError, ValueError, KeyError):
+        return None
+
+def load_manifest(key):
+    try:
+        with open(manifest_path(key), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_manifest(manifest):
+    path = manifest_path(manifest['key'])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # A temp file unique across processes, since the viewer and the pipeline both save manifests
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def listing_photos(key):
+    """Image files for a listing, in gallery order, from its manifest"""
+    manifest = load_manifest(key)
+    if not manifest:
+        return []
+    paths = [object_path(photo['sha256']) for photo in manifest['photos']]
+    return [path for path in paths if os.path.exists(path)]
+
+def download_object(url, headers=None):
+    """Download one image into the object store; returns its digest, or None if the URL is not a photo.
+
+    Identical images (a relisted or duplicated property) are stored once.
+    """
+    response = client.get(url, headers=headers, stream=True, timeout=5)
+    with response:
+        if response.status_code != 200:
+            return None
+        os.makedirs(objects_dir, exist_ok=True)
+        # Write to a temp file so an interrupted download is not mistaken for a finished one.
+        # Its name is unique across processes: the viewer and the pipeline both download here.
+        fd, tmp_path = tempfile.mkstemp(dir=objects_dir, prefix='download.', suffix='.part')
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(64 * 1024):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    metrics.count('photo_bytes', len(chunk))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    metrics.count('photos_downloaded')
+
+    path = object_path(digest.hexdigest())
+    if os.path.exists(path):
+        metrics.count('photo_duplicates')
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+    return digest.hexdigest()
+
+def sync_photos(key, photo_set, photo_count=None, headers=None):
+    """Bring a listing's photos up to date, fetching only what its manifest lacks.
+
+    photo_count is the number of photos when the source knows it; otherwise
+    indexes are probed up to max_photos until the first missing one, and the
+    result is remembered so later runs do not probe again.
+    """
+    photo_set = [str(part) for part in photo_set]
+    headers = headers or download_headers
+    manifest = load_manifest(key)
+    changed = False  # Manifest must be saved even if nothing is fetched
+    if not manifest or manifest['photo_set'] != photo_set:
+        _, shared = synced_sets.get(photo_set)
+        changed = bool(shared)
+        manifest = {'key': key, 'photo_set': photo_set, 'count': None, 'photos': [], 'checked': 0}
+        if shared:
+            manifest.update(count=shared['count'], photos=list(shared['photos']), checked=shared['checked'])
+
+    limit = min(photo_count, max_photos) if photo_count else max_photos
+    if manifest['count'] is not None and not photo_count:
+        stale = time.time() - manifest['checked'] > recheck_after_days * 86400
+        limit = max_photos if stale else min(manifest['count'], max_photos)
+
+    photos = {photo['index']: photo for photo in manifest['photos']}
+    count = limit  # Every index below limit exists unless a probe finds the end first
+    fetched = False
+    try:
+        for index in range(limit):
+            if index in photos and os.path.exists(object_path(photos[index]['sha256'])):
+                metrics.count('cache_hits', cache='photo')
+                continue
+            metrics.count('cache_misses', cache='photo')
+            url = photo_url(photo_set, index)
+            fetched = True
+            digest = download_object(url, headers)
+            if digest is None:
+                if index == 0:
+                    print(f"First image not found for: {photo_set[2]}")
+                count = index
+                break  # Stop if image doesn't exist (likely end of photo set)
+            photos[index] = {'index': index, 'url': url, 'sha256': digest}
+            print(f"Downloaded: {url}")
+    except requests.RequestException as e:
+        print(f"Failed to download photos for {key}: {e}")
+        count = None  # Unknown until a sync gets to the end of the set
+
+    if fetched or changed or count != manifest['count']:
+        manifest['photos'] = [photos[index] for index in sorted(photos) if count is None or index < count]
+        manifest['count'] = count
+        if count is not None:
+            manifest['checked'] = time.time()
+        save_manifest(manifest)
+    synced_sets.put(photo_set, manifest)
+    return manifest
+
+def queue_sync(key, photo_set, photo_count=None, headers=None):
+    """Sync a listing's photos in the background; returns the job. Listings run in parallel."""
+    # Waits here when too many listings are queued, so memory stays bounded
+    sync_slots.acquire()
+    job = sync_executor.submit(sync_photos, key, photo_set, photo_count, headers)
+    with sync_jobs_lock:
+        sync_jobs.add(job)
+    job.add_done_callback(sync_finished)
+    return job
+
+def sync_finished(job):
+    with sync_jobs_lock:
+        sync_jobs.discard(job)
+    sync_slots.release()
+    if job.exception():
+        print(f"Photo download failed: {job.exception()}")
+
+def wait_for_syncs():
+    """Block until every queued photo sync has finished"""
+    with sync_jobs_lock:
+        pending = list(sync_jobs)
+    wait(pending)
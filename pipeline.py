@@ -0,0 +1,335 @@
+import argparse
+import functools
+import hashlib
+import importlib
+import json
+import os
+import queue
+import threading
+import time
+from metrics import metrics
+from property_store import PropertyStore, write_batch_size
+
+# Configuration
+state_file = '.pipeline_state.json'
+scrape_max_age_hours = 12  # Reuse the last scrape if it is newer than this and nothing changed
+stream_buffer = 500  # Rows buffered between a stage and each stage reading from it
+metrics_file = 'pipeline_metrics.json'  # Run report: stage timings, request latencies and cache hit ratios
+prometheus_file = None  # Also write the metrics here in Prometheus text format, e.g. for node_exporter's textfile collector
+
+# The pipeline DAG. Each stage reads the rows produced by the stage named in
+# 'input' (if any) and writes the columns it owns to the property store. A
+# stage's fingerprint covers its script (where its configuration lives), the
+# helper modules listed in 'sources', the files named by the module settings
+# listed in 'data_files', and the store columns owned by every stage upstream.
+stages = [
+    {
+        'name': 'properties',
+        'module': '1_get_properties',
+        'sources': ['canonical_keys'],
+        'input': None,
+        'max_age_hours': scrape_max_age_hours,
+        'columns': lambda m: m.columns,
+        'stream': lambda m, rows, store: m.stream_properties(store)
+    },
+    {
+        'name': 'drive_time',
+        'module': '2_get_drive_time',
+        'sources': ['canonical_keys', 'geocode_cache', 'road_graph', '4_filter_properties'],
+        'data_files': ['road_graph_extract'],
+        'input': 'properties',
+        'columns': lambda m: m.owned_columns(m.destination_columns()),
+        'stream': lambda m, rows, store: m.stream_drive_times(rows, store)
+    },
+    {
+        'name': 'flood_zone',
+        'module': '3_get_flood_zone',
+        'sources': ['canonical_keys', 'flood_index', '4_filter_properties'],
+        'data_files': ['nfhl_extract'],
+        'input': 'drive_time',
+        'columns': lambda m: m.columns,
+        'stream': lambda m, rows, store: m.stream_flood_zones(rows, store)
+    },
+    {
+        'name': 'filter',
+        'module': '4_filter_properties',
+        'sources': [],
+        'input': 'flood_zone',
+        'columns': lambda m: m.columns,
+        'stream': lambda m, rows, store: m.stream_filtered(rows)
+    },
+]
+
+DONE = object()
+
+class StageFailed(Exception):
+    pass
+
+def topological_order(stages):
+    by_name = {stage['name']: stage for stage in stages}
+    ordered, seen = [], set()
+
+    def visit(stage, path=()):
+        if stage['name'] in seen:
+            return
+        if stage['name'] in path:
+            raise ValueError(f"Pipeline has a cycle through {stage['name']}")
+        if stage['input']:
+            visit(by_name[stage['input']], path + (stage['name'],))
+        seen.add(stage['name'])
+        ordered.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return ordered
+
+def stage_columns(name):
+    """Store columns the named stage owns, in the stage's own fixed order"""
+    stage = next(stage for stage in stages if stage['name'] == name)
+    return list(stage['columns'](importlib.import_module(stage['module'])))
+
+def input_columns(name):
+    """Store columns a stage reads: those owned by every stage upstream of it"""
+    by_name = {stage['name']: stage for stage in stages}
+    stage, columns = by_name[name], []
+    while stage['input']:
+        stage = by_name[stage['input']]
+        columns = stage_columns(stage['name']) + columns
+    return columns
+
+def column_order():
+    """Every stage's columns in pipeline order; the table's own order depends on which stage added its columns first"""
+    columns = []
+    for stage in topological_order(stages):
+        columns += [name for name in stage_columns(stage['name']) if name not in columns]
+    return columns
+
+def file_digest(path, digest):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+def upstream_columns(stage, by_name, modules):
+    """Every store column written by the stages this stage depends on"""
+    columns = []
+    while stage['input']:
+        stage = by_name[stage['input']]
+        columns += list(stage['columns'](modules[stage['name']]))
+    return columns
+
+def fingerprint(stage, module, store, input_columns):
+    """Hash of everything a stage's output depends on: its code/config, data files and input columns"""
+    digest = hashlib.sha256()
+    paths = [module.__file__] + [importlib.import_module(name).__file__ for name in stage['sources']]
+    paths += [getattr(module, name) for name in stage.get('data_files', [])]
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        if os.path.exists(path):
+            file_digest(path, digest)
+    if input_columns:
+        digest.update(store.digest(input_columns).encode())
+    return digest.hexdigest()
+
+def load_state():
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            return json.load(f)
+    return {}
+
+def save_state(state):
+    tmp_path = state_file + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_file)
+
+def is_current(stage, module, store, input_columns, state):
+    """True if the stage's stored columns are still valid for its current inputs"""
+    previous = state.get(stage['name'])
+    if not previous or not set(stage['columns'](module)) <= set(store.column_types()):
+        return False
+    if previous['fingerprint'] != fingerprint(stage, module, store, input_columns):
+        return False
+    max_age = stage.get('max_age_hours')
+    return max_age is None or time.time() - previous['finished_at'] < max_age * 3600
+
+class Stream:
+    """Bounded hand-off of one stage's rows to one downstream stage"""
+
+    def __init__(self, abort):
+        self.queue = queue.Queue(maxsize=stream_buffer)
+        self.abort = abort
+
+    def put(self, item):
+        while True:
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                if self.abort.is_set():
+                    raise StageFailed("Pipeline aborted")
+
+    def get(self):
+        while True:
+            try:
+                return self.queue.get(timeout=0.5)
+            except queue.Empty:
+                if self.abort.is_set():
+                    raise StageFailed("Pipeline aborted")
+
+    def read(self):
+        """Rows as sent by the upstream stage"""
+        while True:
+            row = self.get()
+            if row is DONE:
+                return
+            if isinstance(row, BaseException):
+                raise StageFailed("Upstream stage failed") from row
+            yield row
+
+def run_stage(stage, module, store, source, outputs, abort, results):
+    """Run one stage in its own thread, storing its columns and streaming rows to downstream stages"""
+    started = time.monotonic()
+    count = 0
+    received = [0]
+    rows = None
+    columns, batch = None, []
+
+    def counted(rows):
+        for row in rows:
+            received[0] += 1
+            yield row
+
+    try:
+        columns, rows = stage['stream'](module, counted(source()) if source else iter(()), store)
+        store.ensure_columns(columns)
+
+        for row in rows:
+            if abort.is_set():
+                raise StageFailed("Pipeline aborted")
+            batch.append(row)
+            if len(batch) >= write_batch_size:
+                store.write(batch, columns)
+                batch = []
+            count += 1
+            for stream in outputs:
+                stream.put(dict(row))  # Each reader gets its own copy to modify
+        store.write(batch, columns)
+
+        # Everything is stored before downstream stages see the end of the stream
+        for stream in outputs:
+            stream.put(DONE)
+        results[stage['name']] = {'status': 'ran', 'rows': count, 'seconds': time.monotonic() - started}
+    except BaseException as e:
+        abort.set()
+        if columns and batch:
+            # Rows the stage produced before failing are still valid; store them
+            try:
+                store.write(batch, columns)
+            except Exception:
+                pass
+        results[stage['name']] = {'status': 'failed', 'rows': count, 'error': repr(e),
+                                  'seconds': time.monotonic() - started}
+        for stream in outputs:
+            try:
+                stream.queue.put_nowait(e)
+            except queue.Full:
+                pass
+    finally:
+        # Let generators run their cleanup (e.g. stopping the page fetcher) even on failure
+        if hasattr(rows, 'close'):
+            rows.close()
+        result = results.get(stage['name'], {})
+        metrics.set('stage_seconds', time.monotonic() - started, stage=stage['name'])
+        metrics.set('stage_rows_in', received[0], stage=stage['name'])
+        metrics.set('stage_rows_out', count, stage=stage['name'])
+        metrics.set('stage_failed', int(result.get('status') == 'failed'), stage=stage['name'])
+
+def write_metrics(report_path, prometheus_path):
+    if report_path:
+        metrics.write_report(report_path)
+        print(f"Metrics report saved to {report_path}")
+    if prometheus_path:
+        metrics.write_prometheus(prometheus_path)
+
+def run_pipeline(force=False, report_path=metrics_file, prometheus_path=prometheus_file):
+    state = load_state()
+    store = PropertyStore()
+    ordered = topological_order(stages)
+    by_name = {stage['name']: stage for stage in ordered}
+    modules = {stage['name']: importlib.import_module(stage['module']) for stage in ordered}
+    inputs = {stage['name']: upstream_columns(stage, by_name, modules) for stage in ordered}
+
+    # A stage is skipped when everything upstream was skipped and its fingerprint still matches
+    skipped = set()
+    for stage in ordered:
+        upstream_current = stage['input'] is None or stage['input'] in skipped
+        if not force and upstream_current and \
+                is_current(stage, modules[stage['name']], store, inputs[stage['name']], state):
+            skipped.add(stage['name'])
+
+    # Forget the fingerprints of stages about to rerun, so an interrupted run is never mistaken for a finished one
+    for stage in ordered:
+        if stage['name'] not in skipped:
+            state.pop(stage['name'], None)
+    save_state(state)
+
+    abort = threading.Event()
+    results = {name: {'status': 'skipped'} for name in skipped}
+    for name in skipped:
+        metrics.set('stage_skipped', 1, stage=name)
+    readers = {stage['name']: [] for stage in ordered}
+    threads = []
+    for stage in ordered:
+        if stage['name'] in skipped:
+            continue
+
+        if stage['input'] is None:
+            source = None
+        elif stage['input'] in skipped:
+            # Only the columns the stages upstream own, as a streamed input would carry
+            source = functools.partial(store.read, inputs[stage['name']])
+        else:
+            # Rows arrive while the upstream stage is still producing them
+            stream = Stream(abort)
+            readers[stage['input']].append(stream)
+            source = stream.read
+
+        thread = threading.Thread(target=run_stage, name=stage['name'],
+                                  args=(stage, modules[stage['name']], store, source,
+                                        readers[stage['name']], abort, results))
+        threads.append((stage, thread))
+
+    for _, thread in threads:
+        thread.start()
+    for _, thread in threads:
+        thread.join()
+
+    # Record fingerprints only for stages that finished, against their final inputs
+    for stage, _ in threads:
+        if results[stage['name']]['status'] == 'ran':
+            state[stage['name']] = {
+                'fingerprint': fingerprint(stage, modules[stage['name']], store, inputs[stage['name']]),
+                'finished_at': time.time()
+            }
+    save_state(state)
+
+    for stage in ordered:
+        result = results[stage['name']]
+        if result['status'] == 'skipped':
+            print(f"{stage['name']}: skipped (inputs unchanged)")
+        else:
+            print(f"{stage['name']}: {result['status']}, {result['rows']} rows in {result['seconds']:.1f}s"
+                  + (f" ({result['error']})" if 'error' in result else ''))
+    write_metrics(report_path, prometheus_path)
+
+    if any(result['status'] == 'failed' for result in results.values()):
+        raise SystemExit(1)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the property pipeline, skipping stages whose inputs are unchanged")
+    parser.add_argument('--force', action='store_true', help="rerun every stage")
+    parser.add_argument('--metrics', default=metrics_file, help="write the run's metrics report (JSON) here")
+    parser.add_argument('--prometheus', default=prometheus_file, help="also write the metrics in Prometheus text format here")
+    args = parser.parse_args()
+    run_pipeline(force=args.force, report_path=args.metrics, prometheus_path=args.prometheus)
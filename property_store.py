@@ -0,0 +1,148 @@
+import hashlib
+import sqlite3
+import threading
+import pandas as pd
+
+# Configuration
+store_path = 'properties.db'
+write_batch_size = 100  # Rows per transaction when writing a stream of rows
+
+KEY = 'Listing Key'
+
+def quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+def coerce(value, sql_type):
+    """Convert a value to the column's type; unparseable numbers become NULL"""
+    if value is None or value == '':
+        return None
+    if sql_type == 'REAL':
+        try:
+            return float(str(value).replace(',', '').replace('$', ''))
+        except ValueError:
+            return None
+    if sql_type == 'INTEGER':
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+    return str(value)
+
+class PropertyStore:
+    """Typed SQLite table holding every listing, one row per listing key.
+
+    Each stage owns a set of columns and only reads and writes those it needs,
+    so no stage reparses or rewrites the whole dataset.
+    """
+
+    def __init__(self, path=store_path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS listings ({quote(KEY)} TEXT PRIMARY KEY, "
+                              f"Active INTEGER NOT NULL DEFAULT 0)")
+
+    @property
+    def conn(self):
+        # One connection per thread; WAL lets pipeline stages read while others write
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = sqlite3.connect(self.path, timeout=60)
+        return self.local.conn
+
+    def column_types(self):
+        return {row[1]: row[2] for row in self.conn.execute("PRAGMA table_info(listings)")}
+
+    def ensure_columns(self, columns):
+        """Add any missing columns; columns maps name -> SQL type"""
+        with self.lock:
+            existing = self.column_types()
+            with self.conn:
+                for name, sql_type in columns.items():
+                    if name not in existing:
+                        self.conn.execute(f"ALTER TABLE listings ADD COLUMN {quote(name)} {sql_type}")
+
+    def write(self, rows, columns):
+        """Upsert only the given columns of rows, keyed by listing key"""
+        names = list(columns)
+        insert_columns = ', '.join(quote(name) for name in [KEY] + names)
+        placeholders = ', '.join('?' * (len(names) + 1))
+        updates = ', '.join(f"{quote(name)} = excluded.{quote(name)}" for name in names) or f"{quote(KEY)} = {quote(KEY)}"
+        sql = (f"INSERT INTO listings ({insert_columns}) VALUES ({placeholders}) "
+               f"ON CONFLICT({quote(KEY)}) DO UPDATE SET {updates}")
+        with self.conn:
+            self.conn.executemany(sql, ([row[KEY]] + [coerce(row.get(name), columns[name]) for name in names]
+                                        for row in rows))
+
+    def write_stream(self, rows, columns):
+        """Write rows in batches as they arrive; returns the number written"""
+        batch, count = [], 0
+        try:
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= write_batch_size:
+                    self.write(batch, columns)
+                    count += len(batch)
+                    batch = []
+        finally:
+            # Rows produced before a failure are still stored
+            if batch:
+                self.write(batch, columns)
+                count += len(batch)
+        return count
+
+    def read(self, columns=None, where="Active = 1", params=()):
+        """Yield rows as dicts of typed values; columns defaults to all, and any not in the table are left out.
+
+        Reads use their own connection, so they see a stable snapshot even while
+        the same thread writes results back.
+        """
+        if columns is not None:
+            existing = self.column_types()
+            columns = [name for name in columns if name in existing and name != KEY]
+        select = '*' if columns is None else ', '.join(quote(name) for name in [KEY] + columns)
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            cursor = conn.execute(f"SELECT {select} FROM listings WHERE {where} ORDER BY {quote(KEY)}", params)
+            names = [description[0] for description in cursor.description]
+            for values in cursor:
+                yield dict(zip(names, values))
+        finally:
+            conn.close()
+
+    def get(self, keys, columns):
+        """Current values of columns for the given listing keys, as {key: row}"""
+        existing = self.column_types()
+        columns = [name for name in columns if name in existing]
+        result = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.read(columns, where=f"{quote(KEY)} IN ({', '.join('?' * len(chunk))})", params=chunk)
+            result.update((row[KEY], row) for row in rows)
+        return result
+
+    def digest(self, columns):
+        """Hash of the given columns over all active listings, for change detection"""
+        existing = self.column_types()
+        digest = hashlib.sha256()
+        for row in self.read([name for name in columns if name in existing]):
+            digest.update(repr(sorted(row.items())).encode())
+        return digest.hexdigest()
+
+    def frame(self, columns=None, where="Active = 1", params=()):
+        """Listings as a pandas DataFrame with float64 numeric columns.
+
+        columns (default all, in table order) fixes which columns the frame has and their order.
+        """
+        types = self.column_types()
+        if columns is not None:
+            columns = [name for name in columns if name in types and name != KEY]
+        select = '*' if columns is None else ', '.join(quote(name) for name in [KEY] + columns)
+        df = pd.read_sql_query(f"SELECT {select} FROM listings WHERE {where} ORDER BY {quote(KEY)}",
+                               self.conn, params=params)
+        for name in df.columns:
+            if types[name] == 'REAL':
+                df[name] = df[name].astype('float64')  # All-NULL columns would otherwise be object
+        return df
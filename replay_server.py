@@ -0,0 +1,346 @@
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from PIL import Image
+import road_graph
+
+# Configuration
+# Area the generated listings, geocodes and flood zones fall in (New Orleans)
+bounds = (29.88, -90.28, 30.04, -89.98)  # (min lat, min lon, max lat, max lon)
+zip_codes = ['70001', '70002', '70003', '70005', '70006', '70115', '70118', '70122']
+cities = ['Metairie', 'Kenner', 'Harahan', 'New Orleans']
+flood_cell_size = 0.01  # Degrees; each grid cell has one flood zone
+photo_size = (320, 240)
+photo_variants = 4
+road_factor = 1.3  # Road distance over straight-line distance
+road_speed_kmh = 45
+road_grid_size = 0.005  # Degrees between the streets of the generated road grid
+
+def flood_zone(lat, lon):
+    """Flood zone of the grid cell containing a point: 'AE', 'X' or None (unmapped)"""
+    row, col = math.floor(lat / flood_cell_size), math.floor(lon / flood_cell_size)
+    bucket = ((row * 73856093) ^ (col * 19349663)) % 10
+    return 'AE' if bucket < 3 else 'X' if bucket < 6 else None
+
+def flood_extract():
+    """GeoJSON flood hazard extract covering bounds, matching flood_zone cell by cell"""
+    features = []
+    min_lat, min_lon, max_lat, max_lon = bounds
+    for row in range(math.floor(min_lat / flood_cell_size), math.ceil(max_lat / flood_cell_size)):
+        for col in range(math.floor(min_lon / flood_cell_size), math.ceil(max_lon / flood_cell_size)):
+            south, west = row * flood_cell_size, col * flood_cell_size
+            zone = flood_zone(south + flood_cell_size / 2, west + flood_cell_size / 2)
+            if zone:
+                ring = [[west, south], [west + flood_cell_size, south], [west + flood_cell_size, south + flood_cell_size],
+                        [west, south + flood_cell_size], [west, south]]
+                features.append({'type': 'Feature', 'properties': {'FLD_ZONE': zone, 'ZONE_SUBTY': None},
+                                 'geometry': {'type': 'Polygon', 'coordinates': [ring]}})
+    return {'type': 'FeatureCollection', 'features': features}
+
+def road_extract():
+    """GeoJSON road grid covering bounds: residential streets with a primary road every fifth line"""
+    features = []
+    min_lat, min_lon, max_lat, max_lon = bounds
+    lats = [min_lat + i * road_grid_size for i in range(math.floor((max_lat - min_lat) / road_grid_size) + 1)]
+    lons = [min_lon + i * road_grid_size for i in range(math.floor((max_lon - min_lon) / road_grid_size) + 1)]
+    for i, lat in enumerate(lats):
+        features.append({'type': 'Feature', 'properties': {'highway': 'primary' if i % 5 == 0 else 'residential'},
+                         'geometry': {'type': 'LineString', 'coordinates': [[lon, lat] for lon in lons]}})
+    for i, lon in enumerate(lons):
+        features.append({'type': 'Feature', 'properties': {'highway': 'primary' if i % 5 == 0 else 'residential'},
+                         'geometry': {'type': 'LineString', 'coordinates': [[lon, lat] for lat in lats]}})
+    return {'type': 'FeatureCollection', 'features': features}
+
+def check_road_graph():
+    """Route over a hand-built three-node extract and check the results against times worked out by hand.
+
+    A-B is a two-way residential street and B-C a one-way primary road from B to C,
+    so C is reachable from A but A is not reachable from C. The extract and its route
+    cache live in a temporary directory. Raises RuntimeError on a mismatch.
+    """
+    a, b, c = (30.0, -90.0), (30.0, -89.99), (30.0, -89.98)
+    ab = road_graph.haversine_meters(*a, *b)
+    bc = road_graph.haversine_meters(*b, *c)
+    residential, primary = (road_graph.road_speeds_kmh[name] / 3.6 for name in ('residential', 'primary'))
+    route_cache_dir = road_graph.route_cache_dir
+    with tempfile.TemporaryDirectory(prefix='road_graph_check_') as directory:
+        path = os.path.join(directory, 'extract.geojson')
+        with open(path, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': [
+                {'type': 'Feature', 'properties': {'highway': 'residential'},
+                 'geometry': {'type': 'LineString', 'coordinates': [[a[1], a[0]], [b[1], b[0]]]}},
+                {'type': 'Feature', 'properties': {'highway': 'primary', 'oneway': 'yes'},
+                 'geometry': {'type': 'LineString', 'coordinates': [[b[1], b[0]], [c[1], c[0]]]}}
+            ]}, f)
+        graph = road_graph.build_graph(path)
+        (node_a, node_b, node_c), _ = graph.snap(*zip(a, b, c))
+        to_a_seconds, to_a_meters = graph.shortest_paths(node_c)
+        from_a_seconds, _ = graph.shortest_paths(node_a)
+        road_graph.route_cache_dir = os.path.join(directory, 'routes')
+        try:
+            (to_c,), = graph.drive_times([a], [c])
+        finally:
+            road_graph.route_cache_dir = route_cache_dir
+
+    checks = [
+        (math.isclose(to_a_seconds[node_a], ab / residential + bc / primary), "A to C takes the wrong time"),
+        (math.isclose(to_a_meters[node_a], ab + bc), "A to C has the wrong distance"),
+        (math.isclose(from_a_seconds[node_b], ab / residential), "B to A takes the wrong time"),
+        (from_a_seconds[node_c] == math.inf, "the one-way road was routed against its direction"),
+        (to_c == {'duration_mins': round((ab / residential + bc / primary) / 60, 1),
+                  'distance_miles': round((ab + bc) / 1609.34, 1)}, f"drive_times gave {to_c} for A to C")
+    ]
+    for passed, problem in checks:
+        if not passed:
+            raise RuntimeError(f"Road graph check failed: {problem}")
+
+def hashed_point(text):
+    """Stable point inside bounds for an address"""
+    digest = hashlib.sha1(text.encode()).digest()
+    min_lat, min_lon, max_lat, max_lon = bounds
+    return (min_lat + (max_lat - min_lat) * int.from_bytes(digest[:4], 'big') / 2 ** 32,
+            min_lon + (max_lon - min_lon) * int.from_bytes(digest[4:8], 'big') / 2 ** 32)
+
+def road_route(origin, destination):
+    """(seconds, meters) for a made-up road trip between two (lat, lon) points"""
+    lat1, lon1 = map(math.radians, origin)
+    lat2, lon2 = map(math.radians, destination)
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    meters = 2 * 6371000 * math.asin(math.sqrt(a)) * road_factor
+    return meters / (road_speed_kmh / 3.6), meters
+
+def make_listings(count, photos_per_listing, seed=0):
+    rng = random.Random(seed)
+    listings = []
+    for i in range(count):
+        home_id = 50000000 + i
+        street = f"{100 + i} {rng.choice(['Oak', 'Elm', 'Pine', 'Cedar', 'Magnolia'])} {rng.choice(['St', 'Ave', 'Dr'])}"
+        listings.append({
+            'home_id': home_id,
+            'street': street,
+            'city': rng.choice(cities),
+            'zip': rng.choice(zip_codes),
+            'price': rng.randrange(90, 220) * 1000,
+            'beds': rng.randint(2, 5),
+            'baths': rng.choice([1.5, 2, 2.5, 3]),
+            'sqft': rng.randrange(1200, 3000, 10),
+            'mls_id': f"25{i:06d}",
+            'photos': photos_per_listing,
+        })
+    return listings
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections is normal here, not worth a traceback
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class ReplayServer:
+    """Local stand-in for Redfin search pages, GIS feed and photo CDN, ArcGIS geocoding, OSRM and FEMA's NFHL.
+
+    Responses are generated from a seeded set of listings in the shape the real
+    services return. latency (seconds, jittered +/-50%) and error_rate (fraction
+    of requests answered 503) apply to every service unless faults overrides them
+    per service, e.g. {'geocode': (0.2, 0.05)}. Counts and bytes served are kept
+    per service in requests and bytes.
+    """
+
+    services = ['search', 'photo', 'geocode', 'batch_geocode', 'osrm', 'fema']
+
+    def __init__(self, listings=200, photos_per_listing=5, page_size=40, latency=0.0, error_rate=0.0,
+                 faults=None, seed=0):
+        self.listings = make_listings(listings, photos_per_listing, seed)
+        self.by_mls = {listing['mls_id']: listing for listing in self.listings}
+        self.page_size = page_size
+        self.faults = {service: (latency, error_rate) for service in self.services}
+        self.faults.update(faults or {})
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.errors = Counter()
+        self.bytes = Counter()
+        self.photo_cache = {}
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive, like the real services
+
+            def do_GET(self):
+                server.handle(self, 'GET')
+
+            def do_POST(self):
+                server.handle(self, 'POST')
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = QuietHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.requests), Counter(self.errors), Counter(self.bytes)
+
+    def handle(self, request, method):
+        url = urlsplit(request.path)
+        query = parse_qs(url.query)
+        if method == 'POST':
+            length = int(request.headers.get('Content-Length', 0))
+            query.update(parse_qs(request.rfile.read(length).decode()))
+
+        if url.path.startswith('/search'):
+            service, respond = 'search', lambda: self.search_page(url.path)
+        elif url.path.endswith('/stingray/api/gis'):
+            service, respond = 'search', lambda: self.gis_feed(query)
+        elif '/bigphoto/' in url.path:
+            service, respond = 'photo', lambda: self.photo(url.path)
+        elif url.path.endswith('/findAddressCandidates'):
+            service, respond = 'geocode', lambda: self.geocode(query)
+        elif url.path.endswith('/geocodeAddresses'):
+            service, respond = 'batch_geocode', lambda: self.batch_geocode(query)
+        elif url.path.startswith('/osrm/'):
+            service, respond = 'osrm', lambda: self.osrm(url.path, query)
+        elif url.path.endswith('/query'):
+            service, respond = 'fema', lambda: self.fema(query)
+        else:
+            service, respond = None, lambda: (404, 'text/plain', b'Not found')
+
+        latency, error_rate = self.faults.get(service, (0.0, 0.0))
+        with self.lock:
+            failed = self.rng.random() < error_rate
+        if latency:
+            time.sleep(latency * (0.5 + self.rng.random()))
+        status, content_type, body = (503, 'text/plain', b'Injected error') if failed else respond()
+
+        with self.lock:
+            self.requests[service] += 1
+            self.errors[service] += failed
+            self.bytes[service] += len(body)
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def search_page(self, path):
+        page = int(path.rsplit('page-', 1)[1]) if '/page-' in path else 1
+        start = (page - 1) * self.page_size
+        cards = []
+        for listing in self.listings[start:start + self.page_size]:
+            mls = listing['mls_id']
+            cards.append(
+                f'<div class="MapHomeCardReact">'
+                f'<img class="bp-Homecard__Photo--image" src="{self.url}/photo/117/islphoto/{mls[-3:]}/genMid.{mls}_0.jpg">'
+                f'<a class="bp-Homecard" href="/LA/{listing["city"]}/{listing["home_id"]}/home/{listing["home_id"]}"></a>'
+                f'<div class="bp-Homecard__Address">{listing["street"]}, {listing["city"]}, LA {listing["zip"]}</div>'
+                f'<span class="bp-Homecard__Price--value">${listing["price"]:,}</span>'
+                f'<div class="bp-Homecard__Stats">'
+                f'<span class="bp-Homecard__Stats--beds">{listing["beds"]} beds</span>'
+                f'<span class="bp-Homecard__Stats--baths">{listing["baths"]} baths</span>'
+                f'<span class="bp-Homecard__Stats--sqft">{listing["sqft"]:,} sq ft</span>'
+                f'</div></div>')
+        if not cards:
+            return 200, 'text/html', b'<html><body>No results</body></html>'
+        if start + self.page_size < len(self.listings):
+            cards.append(f'<span class="ButtonLabel">{page + 1}</span>')
+        return 200, 'text/html', ('<html><body>' + ''.join(cards) + '</body></html>').encode()
+
+    def gis_feed(self, query):
+        """One page of the GIS search feed, in the shape of a recorded /stingray/api/gis response"""
+        page_size = int(query.get('num_homes', ['350'])[0])
+        page = int(query.get('page_number', ['1'])[0])
+        homes = []
+        for listing in self.listings[(page - 1) * page_size:page * page_size]:
+            lat, lon = hashed_point(f"{listing['street']}, {listing['city']}, LA {listing['zip']}")
+            homes.append({
+                'mlsId': {'value': listing['mls_id'], 'level': 1},
+                'price': {'value': listing['price'], 'level': 1},
+                'sqFt': {'value': listing['sqft'], 'level': 1},
+                'beds': listing['beds'],
+                'baths': listing['baths'],
+                'streetLine': {'value': listing['street'], 'level': 1},
+                'city': listing['city'],
+                'state': 'LA',
+                'zip': listing['zip'],
+                'postalCode': {'value': listing['zip'], 'level': 1},
+                'latLong': {'value': {'latitude': lat, 'longitude': lon}, 'level': 1},
+                'url': f"/LA/{listing['city']}/{listing['home_id']}/home/{listing['home_id']}",
+                'dataSourceId': 117,
+                'photos': {'value': f"0-{listing['photos'] - 1}:0" if listing['photos'] else '', 'level': 1},
+            })
+        data = {'version': 520, 'errorMessage': 'Success', 'resultCode': 0,
+                'payload': {'homes': homes}}
+        # The real feed is prefixed so it cannot be evaluated as a script
+        return 200, 'application/json', ('{}&&' + json.dumps(data)).encode()
+
+    def photo(self, path):
+        # .../bigphoto/{folder}/{mls}_{top}.jpg for the first photo, {mls}_{index}_{top}.jpg after that
+        parts = path.rsplit('/', 1)[1][:-len('.jpg')].split('_')
+        index = int(parts[1]) if len(parts) == 3 else 0
+        listing = self.by_mls.get(parts[0])
+        if not listing or index >= listing['photos']:
+            return 404, 'text/plain', b'Not found'
+        # A few real JPEGs, made unique per photo by bytes after the end-of-image marker, which decoders ignore
+        variant = index % photo_variants
+        if variant not in self.photo_cache:
+            image = Image.effect_noise(photo_size, 40 + variant * 10).convert('RGB')
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=80)
+            self.photo_cache[variant] = buffer.getvalue()
+        return 200, 'image/jpeg', self.photo_cache[variant] + f"{parts[0]}:{index}".encode()
+
+    def geocode(self, query):
+        lat, lon = hashed_point(query.get('singleLine', [''])[0])
+        return self.json({'candidates': [{'address': query.get('singleLine', [''])[0], 'score': 100,
+                                          'location': {'x': lon, 'y': lat}}]})
+
+    def batch_geocode(self, query):
+        records = json.loads(query['addresses'][0])['records']
+        locations = []
+        for record in records:
+            lat, lon = hashed_point(record['attributes']['SingleLine'])
+            locations.append({'attributes': {'ResultID': record['attributes']['OBJECTID'], 'Status': 'M'},
+                              'location': {'x': lon, 'y': lat}})
+        return self.json({'locations': locations})
+
+    def osrm(self, path, query):
+        service, coordinates = path.split('/')[2], path.split('/', 5)[5]
+        points = [tuple(reversed([float(value) for value in pair.split(',')])) for pair in coordinates.split(';')]
+        if service == 'route':
+            seconds, meters = road_route(points[0], points[-1])
+            return self.json({'code': 'Ok', 'routes': [{'duration': seconds, 'distance': meters}]})
+
+        sources = [int(i) for i in query['sources'][0].split(';')]
+        destinations = [int(i) for i in query['destinations'][0].split(';')]
+        routes = [[road_route(points[s], points[d]) for d in destinations] for s in sources]
+        return self.json({'code': 'Ok', 'durations': [[r[0] for r in row] for row in routes],
+                          'distances': [[r[1] for r in row] for row in routes]})
+
+    def fema(self, query):
+        lon, lat = (float(value) for value in query['geometry'][0].split(','))
+        zone = flood_zone(lat, lon)
+        features = [{'attributes': {'FLD_ZONE': zone, 'ZONE_SUBTY': None}}] if zone else []
+        return self.json({'features': features})
+
+    def json(self, data):
+        return 200, 'application/json', json.dumps(data).encode()
@@ -0,0 +1,293 @@
+import hashlib
+import heapq
+import json
+import os
+import xml.etree.ElementTree as ET
+import numpy as np
+
+# Configuration
+# Free-flow speed for each OSM highway class; a way's own maxspeed tag takes precedence
+road_speeds_kmh = {
+    'motorway': 105, 'motorway_link': 60,
+    'trunk': 90, 'trunk_link': 50,
+    'primary': 65, 'primary_link': 45,
+    'secondary': 55, 'secondary_link': 40,
+    'tertiary': 45, 'tertiary_link': 35,
+    'unclassified': 40, 'residential': 30,
+    'living_street': 10, 'service': 15
+}
+snap_cell_degrees = 0.005  # Grid cell size of the node index used to snap points to the graph
+snap_max_meters = 2000  # Points farther than this from any road node are left unrouted
+snap_speed_kmh = 15  # Speed assumed between a point and the node it snaps to
+route_cache_dir = 'road_routes'  # Per-destination search results
+graph_version = 1
+
+def settings_digest():
+    """Hash of the settings that change travel times, so graphs and routes built with other values are not reused"""
+    settings = [sorted(road_speeds_kmh.items()), snap_speed_kmh, snap_max_meters]
+    return hashlib.sha256(json.dumps(settings).encode()).hexdigest()
+
+def haversine_meters(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(value, dtype=np.float64)) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371000 * np.arcsin(np.sqrt(a))
+
+def parse_speed(tags):
+    """km/h for a way from its maxspeed tag ('50', '35 mph') or its highway class; None if not routable"""
+    default = road_speeds_kmh.get(tags.get('highway'))
+    if default is None:
+        return None
+    maxspeed = str(tags.get('maxspeed') or '').strip().lower()
+    try:
+        if maxspeed.endswith('mph'):
+            return float(maxspeed[:-3]) * 1.609
+        if maxspeed:
+            return float(maxspeed)
+    except ValueError:
+        pass
+    return default
+
+def directions(tags):
+    """(forward, backward) travel allowed along a way"""
+    oneway = str(tags.get('oneway') or '').lower()
+    if oneway == '-1':
+        return False, True
+    if oneway in ('yes', 'true', '1') or (not oneway and tags.get('highway') == 'motorway'):
+        return True, False
+    return True, True
+
+def read_ways(path):
+    """Yield (tags, [(lat, lon), ...]) for each way in an OSM XML or GeoJSON road extract"""
+    if path.lower().endswith('.osm'):
+        nodes, ways = {}, []
+        for _, element in ET.iterparse(path):
+            if element.tag == 'node':
+                nodes[element.get('id')] = (float(element.get('lat')), float(element.get('lon')))
+            elif element.tag == 'way':
+                tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+                if tags.get('highway') in road_speeds_kmh:
+                    ways.append((tags, [nd.get('ref') for nd in element.iter('nd')]))
+            if element.tag in ('node', 'way', 'relation'):
+                element.clear()
+        for tags, refs in ways:
+            yield tags, [nodes[ref] for ref in refs if ref in nodes]
+        return
+
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    for feature in data.get('features', []):
+        geometry = feature.get('geometry') or {}
+        lines = [geometry.get('coordinates', [])] if geometry.get('type') == 'LineString' else \
+            geometry.get('coordinates', []) if geometry.get('type') == 'MultiLineString' else []
+        for line in lines:
+            yield feature.get('properties') or {}, [(point[1], point[0]) for point in line]
+
+def build_graph(extract_path):
+    """Load a road extract into node coordinate arrays, a reverse CSR adjacency and a snapping grid"""
+    node_ids = {}
+    edges = []  # (source node, target node, km/h)
+    for tags, points in read_ways(extract_path):
+        speed = parse_speed(tags)
+        if speed is None or speed <= 0:
+            continue
+        forward, backward = directions(tags)
+        # Nodes are identified by position, so ways sharing a point are joined there
+        ids = [node_ids.setdefault((round(lat, 7), round(lon, 7)), len(node_ids)) for lat, lon in points]
+        for a, b in zip(ids, ids[1:]):
+            if a == b:
+                continue
+            if forward:
+                edges.append((a, b, speed))
+            if backward:
+                edges.append((b, a, speed))
+
+    coords = np.array(list(node_ids), dtype=np.float64).reshape(-1, 2)
+    edges = np.array(edges, dtype=np.float64).reshape(-1, 3)
+    sources, targets = edges[:, 0].astype(np.int64), edges[:, 1].astype(np.int64)
+    meters = haversine_meters(coords[sources, 0], coords[sources, 1], coords[targets, 0], coords[targets, 1])
+    seconds = meters / (edges[:, 2] / 3.6)
+
+    # Edges grouped by their target node, so a search can walk them backwards from a destination
+    order = np.argsort(targets, kind='stable')
+    reverse_offsets = np.concatenate([[0], np.cumsum(np.bincount(targets, minlength=len(coords)))])
+
+    # Nodes grouped by grid cell for snapping
+    cells = cell_keys(coords[:, 0], coords[:, 1])
+    node_order = np.argsort(cells, kind='stable')
+    grid_keys, grid_starts = np.unique(cells[node_order], return_index=True)
+
+    digest = hashlib.sha256()
+    with open(extract_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    return RoadGraph({
+        'version': np.array(graph_version),
+        'source_digest': np.array(digest.hexdigest()),
+        'settings_digest': np.array(settings_digest()),
+        'lats': coords[:, 0],
+        'lons': coords[:, 1],
+        'reverse_offsets': reverse_offsets,
+        'reverse_sources': sources[order],
+        'reverse_seconds': seconds[order],
+        'reverse_meters': meters[order],
+        'grid_keys': grid_keys,
+        'grid_offsets': np.concatenate([grid_starts, [len(coords)]]).astype(np.int64),
+        'grid_nodes': node_order
+    })
+
+def cell_keys(lats, lons):
+    rows = np.floor(np.asarray(lats) / snap_cell_degrees).astype(np.int64)
+    cols = np.floor(np.asarray(lons) / snap_cell_degrees).astype(np.int64)
+    return rows * (1 << 32) + cols
+
+class RoadGraph:
+    """Road network packed into numpy arrays, routed with one reverse search per destination"""
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.lats = arrays['lats']
+        self.lons = arrays['lons']
+        self.reverse_offsets = arrays['reverse_offsets']
+        self.reverse_sources = arrays['reverse_sources']
+        self.reverse_seconds = arrays['reverse_seconds']
+        self.reverse_meters = arrays['reverse_meters']
+        self.grid_keys = arrays['grid_keys']
+        self.grid_offsets = arrays['grid_offsets']
+        self.grid_nodes = arrays['grid_nodes']
+        # Identifies the extract and settings the graph was built with in cache keys
+        self.key = str(arrays['source_digest'])[:16] + str(arrays['settings_digest'])[:8]
+        self.trees = {}
+
+    @classmethod
+    def load(cls, extract_path, graph_path):
+        """Load the serialized graph, rebuilding it when the extract is newer or the speed settings changed.
+
+        A valid graph is used as it is when the extract is no longer there.
+        """
+        if os.path.exists(graph_path) and (not os.path.exists(extract_path) or
+                                           os.path.getmtime(graph_path) >= os.path.getmtime(extract_path)):
+            with np.load(graph_path) as data:
+                arrays = {key: data[key] for key in data.files}
+            if int(arrays['version']) == graph_version and \
+                    str(arrays.get('settings_digest')) == settings_digest():
+                return cls(arrays)
+
+        print(f"Building road graph from {extract_path}...")
+        graph = build_graph(extract_path)
+        np.savez(graph_path, **graph.arrays)
+        return graph
+
+    def shortest_paths(self, node):
+        """(seconds, meters) from every node to node along the fastest route; inf where unreachable"""
+        offsets = self.reverse_offsets.tolist()
+        sources = self.reverse_sources.tolist()
+        edge_seconds = self.reverse_seconds.tolist()
+        edge_meters = self.reverse_meters.tolist()
+        seconds = [float('inf')] * len(offsets[:-1])
+        meters = [float('inf')] * len(seconds)
+        seconds[node], meters[node] = 0.0, 0.0
+        heap = [(0.0, node)]
+        while heap:
+            time, current = heapq.heappop(heap)
+            if time > seconds[current]:
+                continue
+            for edge in range(offsets[current], offsets[current + 1]):
+                previous = sources[edge]
+                candidate = time + edge_seconds[edge]
+                if candidate < seconds[previous]:
+                    seconds[previous] = candidate
+                    meters[previous] = meters[current] + edge_meters[edge]
+                    heapq.heappush(heap, (candidate, previous))
+        return np.array(seconds), np.array(meters)
+
+    def tree(self, lat, lon):
+        """Search results towards a destination, from memory, the route cache on disk, or a new search.
+
+        Returns (seconds, meters) per node, or None if the destination is not near a road.
+        """
+        key = f"{self.key}_{lat:.6f}_{lon:.6f}"
+        if key in self.trees:
+            return self.trees[key]
+
+        path = os.path.join(route_cache_dir, key + '.npz')
+        if os.path.exists(path):
+            with np.load(path) as data:
+                self.trees[key] = (data['seconds'], data['meters'])
+            return self.trees[key]
+
+        nodes, offsets = self.snap([lat], [lon])
+        if nodes[0] < 0:
+            self.trees[key] = None
+            return None
+        seconds, meters = self.shortest_paths(int(nodes[0]))
+        seconds += offsets[0] / (snap_speed_kmh / 3.6)
+        meters += offsets[0]
+        os.makedirs(route_cache_dir, exist_ok=True)
+        np.savez(path, seconds=seconds, meters=meters)
+        self.trees[key] = (seconds, meters)
+        return self.trees[key]
+
+    def snap(self, lats, lons, usable=None):
+        """Nearest node (or -1) and its distance in meters for each point, searching outward cell by cell.
+
+        usable optionally masks the nodes that may be snapped to.
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        nodes = np.full(len(lats), -1, dtype=np.int64)
+        distances = np.full(len(lats), np.inf)
+        # Cells are at least half as wide as tall up to 60 degrees latitude
+        max_ring = int(np.ceil(snap_max_meters / (snap_cell_degrees * 111000 * 0.5))) + 1
+        rows = np.floor(lats / snap_cell_degrees).astype(np.int64)
+        cols = np.floor(lons / snap_cell_degrees).astype(np.int64)
+
+        for i in range(len(lats)):
+            candidates = []
+            found_ring = None
+            for ring in range(max_ring + 1):
+                # A node in the next ring can still be nearer than one found in this ring
+                if found_ring is not None and ring > found_ring + 1:
+                    break
+                for row in range(rows[i] - ring, rows[i] + ring + 1):
+                    for col in range(cols[i] - ring, cols[i] + ring + 1):
+                        if max(abs(row - rows[i]), abs(col - cols[i])) != ring:
+                            continue
+                        cell = np.searchsorted(self.grid_keys, row * (1 << 32) + col)
+                        if cell < len(self.grid_keys) and self.grid_keys[cell] == row * (1 << 32) + col:
+                            members = self.grid_nodes[self.grid_offsets[cell]:self.grid_offsets[cell + 1]]
+                            if usable is not None:
+                                members = members[usable[members]]
+                            if len(members):
+                                candidates.append(members)
+                                if found_ring is None:
+                                    found_ring = ring
+            if not candidates:
+                continue
+            members = np.concatenate(candidates)
+            meters = haversine_meters(lats[i], lons[i], self.lats[members], self.lons[members])
+            best = int(np.argmin(meters))
+            if meters[best] <= snap_max_meters:
+                nodes[i], distances[i] = members[best], meters[best]
+        return nodes, distances
+
+    def drive_times(self, origins, dest_coords):
+        """Drive times from many origins to each destination, shaped like get_drive_times' OSRM results"""
+        results = [[None] * len(dest_coords) for _ in origins]
+        if not len(origins):
+            return results
+        lats, lons = (np.array([origin[i] for origin in origins], dtype=np.float64) for i in (0, 1))
+        for j, (lat, lon) in enumerate(dest_coords):
+            tree = self.tree(lat, lon)
+            if tree is None:
+                continue
+            seconds, meters = tree
+            # Only snap to nodes that can reach this destination, so a dead-end service road never wins
+            nodes, offsets = self.snap(lats, lons, usable=np.isfinite(seconds))
+            for i, (node, offset) in enumerate(zip(nodes, offsets)):
+                if node >= 0:
+                    results[i][j] = {
+                        'duration_mins': round(float(seconds[node] + offset / (snap_speed_kmh / 3.6)) / 60, 1),
+                        'distance_miles': round(float(meters[node] + offset) / 1609.34, 1)
+                    }
+        return results
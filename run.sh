@@ -17,18 +17,9 @@ echo "Installing dependencies..."
 pip install --upgrade pip
 pip install -r requirements.txt
 
-# Run Python scripts in sequence
-echo "Running 1_get_properties.py..."
-python 1_get_properties.py
-
-echo "Running 2_get_drive_time.py..."
-python 2_get_drive_time.py
-
-echo "Running 3_get_flood_zone.py..."
-python 3_get_flood_zone.py
-
-echo "Running 4_filter_properties.py..."
-python 4_filter_properties.py
+# Run stages 1-4; unchanged stages are skipped and the rest stream rows into each other
+echo "Running pipeline.py..."
+python pipeline.py
 
 echo "Running 5_ui.py..."
 python 5_ui.py
@@ -0,0 +1,119 @@
+import hashlib
+import itertools
+import os
+import queue
+import tempfile
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+# Configuration
+thumbnail_dir = 'Thumbnails'  # Sits next to Photos/; safe to delete at any time
+gallery_size = (280, 280)
+popup_size = (800, 600)
+memory_items = 200  # Decoded images held in memory, least recently used dropped first
+decode_workers = 4
+
+def thumbnail_path(image_path, size):
+    """Cache file for an image at a size; changes whenever the source file does"""
+    stat = os.stat(image_path)
+    key = f"{os.path.abspath(image_path)}|{stat.st_size}|{stat.st_mtime_ns}|{size[0]}x{size[1]}"
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    return os.path.join(thumbnail_dir, digest[:2], digest + '.jpg')
+
+def load_thumbnail(image_path, size):
+    """Decoded RGB image no larger than size, read from the disk cache or made and stored there"""
+    cache_path = thumbnail_path(image_path, size)
+    if os.path.exists(cache_path):
+        with Image.open(cache_path) as img:
+            img.load()
+            return img
+
+    with Image.open(image_path) as img:
+        img.draft('RGB', size)  # Let the JPEG decoder scale down while decoding
+        img = img.convert('RGB')
+    img.thumbnail(size)
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # Unique across processes, so two viewers caching the same thumbnail never share a temp file
+    fd, part_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            img.save(f, 'JPEG', quality=85)
+        os.replace(part_path, cache_path)
+    except BaseException:
+        os.remove(part_path)
+        raise
+    return img
+
+class ThumbnailLoader:
+    """Decodes thumbnails on worker threads and keeps the most recent ones in memory.
+
+    Callbacks run on a worker thread with the PIL image (None if it failed to
+    load); Tk callers should hand the result back to the main loop themselves.
+    Requests made for display are served before prefetches.
+    """
+
+    def __init__(self, workers=decode_workers, capacity=memory_items):
+        self.capacity = capacity
+        self.images = OrderedDict()
+        self.pending = {}  # (path, size) -> callbacks waiting for it
+        self.decoding = set()
+        self.lock = threading.Lock()
+        self.requests = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        for _ in range(workers):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def cached(self, path, size):
+        with self.lock:
+            image = self.images.get((path, size))
+            if image is not None:
+                self.images.move_to_end((path, size))
+            return image
+
+    def request(self, path, size, callback=None, priority=0):
+        image = self.cached(path, size)
+        if image is not None:
+            if callback:
+                callback(image)
+            return
+        key = (path, size)
+        with self.lock:
+            queued = key in self.pending
+            callbacks = self.pending.setdefault(key, [])
+            if callback:
+                callbacks.append(callback)
+        if not queued or priority == 0:
+            # A display request for an image already waiting as a prefetch jumps the queue
+            self.requests.put((priority, next(self.sequence), key))
+
+    def prefetch(self, paths, size):
+        for path in paths:
+            self.request(path, size, priority=1)
+
+    def work(self):
+        while True:
+            _, _, key = self.requests.get()
+            with self.lock:
+                if key not in self.pending or key in self.decoding:
+                    continue  # Served, or being served, by an earlier copy of this request
+                self.decoding.add(key)
+            try:
+                image = self.cached(*key)
+                if image is None:
+                    image = load_thumbnail(*key)
+            except Exception as e:
+                print(f"Error loading {key[0]}: {e}")
+                image = None
+
+            with self.lock:
+                if image is not None:
+                    self.images[key] = image
+                    self.images.move_to_end(key)
+                    while len(self.images) > self.capacity:
+                        self.images.popitem(last=False)
+                callbacks = self.pending.pop(key, [])
+                self.decoding.discard(key)
+            for callback in callbacks:
+                callback(image)